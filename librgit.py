@@ -13,13 +13,23 @@ pwd -> Unix users, for displaying author
 hashlib -> for hashing
 zlib -> compression
 re -> regular expressions
-math -> math functions
+mmap -> memory-mapped packfiles, pack indexes and the commit-graph
+struct -> packing/unpacking binary formats (pack, idx)
+tempfile -> temporary files, renamed in place once complete
+concurrent.futures -> thread pools (zlib and hashlib release the GIL)
+bisect -> binary search in the sorted index
+stat -> interpreting file modes
+socket, select -> fsmonitor daemon and its clients
+ctypes, errno -> inotify binding for the fsmonitor daemon
+time -> fsmonitor polling interval
+json -> cache of the parsed ignore rules
+heapq -> priority queues of the revision walk and of merge-base
 """
 
-from datetime import datetime
+from datetime import datetime, timezone, timedelta
 from fnmatch import fnmatch
-import os, sys, argparse, collections, configparser, grp, pwd, hashlib, zlib, re
-from math import ceil
+import os, sys, argparse, collections, configparser, grp, pwd, hashlib, zlib, re, mmap, struct, tempfile
+import concurrent.futures, bisect, stat, socket, select, ctypes, ctypes.util, errno, time, json, heapq
 
 
 """RGIT INTERNALS"""
@@ -28,10 +38,20 @@ class RgitRepository(object):
     worktree = None
     gitdir = None
     conf = None
+    #opened packfiles, loaded on first use (see repo_packs)
+    packs = None
+    #resolved delta bases, keyed by (pack name, offset)
+    delta_cache = None
+    #parsed commits, trees and tags, keyed by sha
+    object_cache = None
+    #objects/info/commit-graph, False if there is none (see repo_commit_graph)
+    commit_graph = None
 
     def __init__(self, path, force=False):
         self.worktree = path
         self.gitdir = os.path.join(path, ".git")
+        self.delta_cache = GitLRUCache(DELTA_BASE_CACHE_LIMIT)
+        self.object_cache = GitLRUCache(OBJECT_CACHE_LIMIT)
 
         if not (force or os.path.isdir(self.gitdir)):
             raise Exception("Not a Rgit repository %s" % path)
@@ -50,15 +70,90 @@ class RgitRepository(object):
             if vers != 0:
                 raise Exception("Unsupported repositoryformatversion %s" % vers)
 
+class GitLRUCache(object):
+    '''LRU mapping bounded by the total size in bytes of its values'''
+    limit = 0
+    size = 0
+    hits = 0
+    misses = 0
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.items = collections.OrderedDict()
+
+    def get(self, key):
+        item = self.items.get(key)
+        if item is None:
+            self.misses += 1
+            return None
+
+        self.items.move_to_end(key)
+        self.hits += 1
+        return item[0]
+
+    def put(self, key, value, size):
+        if size > self.limit:
+            return
+
+        if key in self.items:
+            self.size -= self.items.pop(key)[1]
+
+        self.items[key] = (value, size)
+        self.size += size
+
+        #evicting the least recently used values
+        while self.size > self.limit:
+            _, (_, evicted) = self.items.popitem(last=False)
+            self.size -= evicted
+
 class GitIgnore(object):
     absolute = None
     scoped = None
+    #gitignore_key of the files the rules were read from
+    key = None
 
-    def __init__(self, absolute, scoped):
+    def __init__(self, absolute, scoped, key=None):
         self.absolute = absolute
         self.scoped = scoped
+        self.key = key
+
+class GitIgnoreMatcher(object):
+    '''A ruleset compiled for matching (see gitignore_compile)'''
+    #file the rules were read from, for check-ignore --verbose
+    source = None
+    #parsed (pattern, value, line number, line) rules, in file order
+    rules = None
+    #for files and for directories (directory-only rules apply to the latter):
+    #literal basename => index of the last rule, extension => index of the last
+    #"*.ext" rule, and the remaining globs as two regexes, one matched against
+    #the basename and one against the path relative to the .gitignore.
+    #Built on first use: most rulesets of a large tree are never matched.
+    _files = None
+    _dirs = None
+
+    def __init__(self, source, rules):
+        self.source = source
+        self.rules = rules
+
+    @property
+    def files(self):
+        if self._files is None:
+            self._files, self._dirs = gitignore_compile_rules(self.rules)
+        return self._files
+
+    @property
+    def dirs(self):
+        if self._dirs is None:
+            self._files, self._dirs = gitignore_compile_rules(self.rules)
+        return self._dirs
 
 class GitIndexEntry(object):
+    #Indexes hold one entry per tracked file: no per-instance __dict__,
+    #and timestamps kept as plain ints rather than tuples
+    __slots__ = ("ctime_s", "ctime_ns", "mtime_s", "mtime_ns", "dev", "ino",
+                 "mode_type", "mode_perms", "uid", "gid", "fsize", "sha",
+                 "flag_assume_valid", "flag_stage", "name")
+
     def __init__(self, ctime=None, mtime=None, dev=None, ino=None,
                 mode_type=None, mode_perms=None, uid=None, gid=None,
                 fsize=None, sha=None, flag_assume_valid=None, flag_stage=None, name=None):
@@ -98,12 +193,42 @@ class GitIndexEntry(object):
         #object name (full path)
         self.name = name
 
+    @property
+    def ctime(self):
+        return (self.ctime_s, self.ctime_ns)
+
+    @ctime.setter
+    def ctime(self, value):
+        self.ctime_s, self.ctime_ns = value if value else (None, None)
+
+    @property
+    def mtime(self):
+        return (self.mtime_s, self.mtime_ns)
+
+    @mtime.setter
+    def mtime(self, value):
+        self.mtime_s, self.mtime_ns = value if value else (None, None)
+
 #begins with DIRC mahic bytes, version number and total number of entries
 class GitIndex(object):
     version = None
     entries = []
     #ext = None
     #sha = None
+    #(seconds, nanoseconds) modification time of the index file when it was read
+    mtime = None
+    #(size, trailing sha-1) of the index file when it was read or last written,
+    #None if there was none: tells if another process replaced it since
+    checksum = None
+    #GitUntrackedCache, stored in the index as the RGUC extension
+    untracked_cache = None
+    #fsmonitor token of the last status and the names of the entries it did not
+    #find clean, stored in the index as the RGFM extension
+    fsmonitor_token = None
+    fsmonitor_invalid = None
+    #directory path ("" for the root) => (number of index entries below it, tree sha),
+    #(-1, None) once a path below it changed: the TREE extension (cache-tree)
+    cache_tree = None
 
     def __init__(self, version=2, entries=None):
         if not entries:
@@ -112,6 +237,21 @@ class GitIndex(object):
         self.version = version
         self.entries = entries
 
+class GitUntrackedCache(object):
+    '''Listing of the worktree directories, reused while their mtime is unchanged'''
+    #sha-1 of the ignore rules the listings were made with (see gitignore_key)
+    key = None
+    #directory path => (mtime, files, subdirectories), ignored names left out
+    dirs = None
+    #directories seen by the current walk, replaces dirs once the walk is over
+    visited = None
+    changed = False
+
+    def __init__(self, key, dirs=None):
+        self.key = key
+        self.dirs = dirs if dirs is not None else dict()
+        self.visited = dict()
+
 class GitObject(object):
 
     def __init__(self, data=None):
@@ -129,48 +269,231 @@ class GitObject(object):
     def init(self):
         pass
 
-def object_read(repo, sha):
+#Bound for the parsed objects cache, on the memory the objects take (see object_cache_size)
+OBJECT_CACHE_LIMIT = 32 * 1024 * 1024
+
+#cache=False for objects read once (commits shown by log): they would only
+#push out of the cache the objects read again
+def object_read(repo, sha, cache=True):
+    #Commits, trees and tags are parsed once per run, history and tree walks
+    #visit the same objects many times. Blobs are never cached.
+    obj = repo.object_cache.get(sha)
+    if obj is not None:
+        return object_copy(obj)
+
+    raw = object_read_raw(repo, sha)
+
+    if raw is None:
+        return None
+
+    format, data = raw
+
+    #Constructor
+    match format:
+        case b'commit' : obj = GitCommit
+        case b'tree' : obj = GitTree
+        case b'tag' : obj=GitTag
+        case b'blob' : obj=GitBlob
+        case _ : raise Exception("Unknown type {0} for object {1}".format(format.decode("ascii"), sha))
+
+    obj = obj(data)
+    if format != b'blob' and cache:
+        if format == b'tree':
+            #found once for the lookups in every copy of the tree
+            obj.offsets = tree_offsets(data)
+            obj.git_order = tree_raw_in_git_order(data, obj.offsets)
+        repo.object_cache.put(sha, obj, object_cache_size(obj))
+        return object_copy(obj)
+
+    return obj
+
+#Cached objects are never handed out: callers get a copy they can modify (tree
+#items, commit headers) without changing what later reads return. The serialized
+#tree and its offsets are shared, they are replaced but never modified.
+def object_copy(obj):
+    if obj.format == b'tree':
+        copy = GitTree(obj.raw)
+        copy.offsets = obj.offsets
+        copy.git_order = obj.git_order
+        return copy
+
+    copy = obj.__class__()
+    copy.keyvaluelist = type(obj.keyvaluelist)(
+        (key, list(value) if type(value) == list else value) for (key, value) in obj.keyvaluelist.items())
+    return copy
+
+#Memory taken by a parsed object in the cache, not just its raw data: the
+#offsets of a tree, the dict and the values of a commit or tag
+def object_cache_size(obj):
+    size = sys.getsizeof(obj) + sys.getsizeof(obj.__dict__)
+
+    if obj.format == b'tree':
+        #the offsets are ints above the small ints python shares, 28 bytes each
+        return size + sys.getsizeof(obj.raw) + sys.getsizeof(obj.offsets) + 28 * len(obj.offsets)
+
+    size += sys.getsizeof(obj.keyvaluelist)
+    for (key, value) in obj.keyvaluelist.items():
+        size += sys.getsizeof(key) + sys.getsizeof(value)
+        if type(value) == list:
+            size += sum(sys.getsizeof(v) for v in value)
+    return size
+
+#Returns the pair (format, data) of an object, packs are searched before loose objects
+def object_read_raw(repo, sha):
+    raw = pack_read(repo, sha)
+    if raw is not None:
+        return raw
+
+    return object_read_loose(repo, sha)
+
+def object_read_loose(repo, sha):
+    stream = object_read_stream_loose(repo, sha)
+
+    if stream is None:
+        return None
+
+    format, size, body = stream
+    return format, b''.join(body)
+
+#Returns (format, size) of an object, reading no more than its header
+def object_read_header(repo, sha):
+    found = pack_find(repo, sha)
+    if found:
+        return pack_read_header_at(repo, *found)
+
+    stream = object_read_stream_loose(repo, sha)
+    if stream is None:
+        return None
+
+    format, size, body = stream
+    body.close()
+    return format, size
+
+""" STREAMING READS
+ object_read_stream returns (format, size, body) where body yields the object data
+ in chunks of at most OBJECT_STREAM_CHUNK bytes. Whole objects are inflated chunk by
+ chunk, only deltas are resolved in memory.
+ """
 
+def object_read_stream(repo, sha):
+    found = pack_find(repo, sha)
+    if found:
+        return pack_read_stream(repo, *found)
+
+    return object_read_stream_loose(repo, sha)
+
+def object_read_stream_loose(repo, sha):
     path = repo_file(repo, "objects", sha[0:2], sha[2:])
 
-    if not os.path.isfile(path):
+    if not path or not os.path.isfile(path):
         return None
 
-    with open(path, "rb") as f:
-        raw = zlib.decompress(f.read())
+    file = open(path, "rb")
+    chunks = zlib_inflate_chunks(file.read, sha)
 
-        #Object type
-        x = raw.find(b' ')
-        format = raw[0:x]
+    #The header is parsed from the first inflated chunk
+    raw = b''
+    for chunk in chunks:
+        raw += chunk
+        if b'\x00' in raw:
+            break
 
-        #Read and validate object size
-        y = raw.find(b'\x00', x)
-        size = int(raw[x:y].decode("ascii"))
-        if size != len(raw)-y-1:
+    #Object type
+    x = raw.find(b' ')
+    y = raw.find(b'\x00', x)
+    if x < 0 or y < 0:
+        file.close()
+        raise Exception("Malformed object {0}: no header".format(sha))
+    format = raw[0:x]
+    size = int(raw[x:y].decode("ascii"))
+
+    return format, size, object_stream_body(raw[y+1:], chunks, size, sha, file)
+
+#Yields the body, validating its size once the whole object was read
+def object_stream_body(first, chunks, size, sha, file=None):
+    try:
+        total = len(first)
+        if first:
+            yield first
+
+        for chunk in chunks:
+            total += len(chunk)
+            yield chunk
+
+        if total != size:
             raise Exception("Malformed object {0}: bad length".format(sha))
+    finally:
+        if file:
+            file.close()
+
+#Inflates a zlib stream from read(n), yielding chunks of at most OBJECT_STREAM_CHUNK bytes
+def zlib_inflate_chunks(read, name):
+    decompressor = zlib.decompressobj()
+
+    while not decompressor.eof:
+        data = decompressor.unconsumed_tail or read(OBJECT_STREAM_CHUNK)
+
+        if not data:
+            chunk = decompressor.flush()
+            if chunk:
+                yield chunk
+            if not decompressor.eof:
+                raise Exception("Malformed object {0}: truncated".format(name))
+            break
 
-        #Constructor
-        match format:
-            case b'commit' : obj = GitCommit
-            case b'tree' : obj = GitTree
-            case b'tag' : obj=GitTag
-            case b'blob' : obj=GitBlob
-            case _ : raise Exception("Unknown type {0} for object {1}".format(format.decode("ascii"), sha))
-        
-        return obj(raw[y+1:])
+        chunk = decompressor.decompress(data, OBJECT_STREAM_CHUNK)
+        if chunk:
+            yield chunk
 
 def object_write(obj, repo=None):
     data = obj.serialize()
-    result = obj.format + b' ' + str(len(data)).encode() + b'\x00' + data
-    sha = hashlib.sha1(result).hexdigest()
+    header = obj.format + b' ' + str(len(data)).encode() + b'\x00'
+    sha = hashlib.sha1(header)
+    sha.update(data)
+    sha = sha.hexdigest()
 
-    if repo:
-        path=repo_file(repo, "objects", sha[0:2], sha[2:], mkdir=True)
+    #objects already stored (loose or in a pack) are not written again
+    if repo and not object_exists(repo, sha):
+        object_write_loose(repo, [header, data])
+
+    return sha
+
+def object_exists(repo, sha):
+    path = repo_file(repo, "objects", sha[0:2], sha[2:])
+    return (path and os.path.exists(path)) or pack_find(repo, sha) is not None
+
+#Chunk size used when hashing and writing objects in constant memory
+OBJECT_STREAM_CHUNK = 64 * 1024
+
+#Writes a loose object from the chunks of header + data, returns its sha.
+#The sha is computed while compressing into a temporary file in objects/, which
+#is then renamed into place: a partially written object is never visible.
+def object_write_loose(repo, chunks):
+    sha = hashlib.sha1()
+    compressor = zlib.compressobj()
+
+    fd, tmp_path = tempfile.mkstemp(prefix="tmp_obj_", dir=repo_dir(repo, "objects"))
+    try:
+        with os.fdopen(fd, "wb") as f:
+            for chunk in chunks:
+                sha.update(chunk)
+                f.write(compressor.compress(chunk))
+            f.write(compressor.flush())
+
+        sha = sha.hexdigest()
+        path = repo_file(repo, "objects", sha[0:2], sha[2:], mkdir=True)
+
+        if os.path.exists(path) or pack_find(repo, sha):
+            os.unlink(tmp_path)
+        else:
+            #objects are never modified, git stores them read-only
+            os.chmod(tmp_path, 0o444)
+            os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
 
-        if not os.path.exists(path):
-            with open(path, 'wb') as f:
-                f.write(zlib.compress(result))
-    
     return sha
 
 class GitBlob(GitObject):
@@ -204,26 +527,730 @@ class GitCommit(GitObject):
  """
 
 class GitTreeLeaf(object):
-    def __init__(self, mode, path, sha):
+    #the sha is kept in binary as in the tree, sha gives it in hex
+    __slots__ = ("mode", "path", "raw_sha")
+
+    def __init__(self, mode, path, sha=None, raw_sha=None):
         self.mode = mode
         self.path = path
-        self.sha = sha
+        self.raw_sha = raw_sha if raw_sha is not None else bytes.fromhex(sha)
+
+    @property
+    def sha(self):
+        return self.raw_sha.hex()
+
+    @sha.setter
+    def sha(self, value):
+        self.raw_sha = bytes.fromhex(value)
 
 class GitTree(GitObject):
     format = b'tree'
-    
+    #serialized tree as read: leaves are decoded from it on demand (see tree_iter,
+    #tree_lookup), it is dropped once items are set
+    raw = None
+    #start of every leaf in raw, for binary search
+    offsets = None
+    #raw is in git order, so lookups can bisect it: trees written by older rgit
+    #put symlinks and submodules with the directories
+    git_order = None
+    #items are known to be in tree order, serialize does not sort them
+    presorted = False
+    _items = None
+
     def deserialize(self, data):
-        self.items = tree_parse(data)
+        self.raw = data
+        self.offsets = None
+        self.git_order = None
+        self._items = None
 
     def serialize(self):
+        #a tree that was read and not modified is written back as is
+        if self._items is None and self.raw is not None:
+            return self.raw
         return tree_serialize(self)
 
     def init(self):
         self.items = list()
 
+    #all the leaves, decoded on first use
+    @property
+    def items(self):
+        if self._items is None:
+            self._items = tree_parse(self.raw) if self.raw is not None else list()
+        return self._items
+
+    @items.setter
+    def items(self, value):
+        self._items = value
+        self.raw = None
+        self.offsets = None
+        self.git_order = None
+        self.presorted = False
+
+    def lookup(self, name):
+        return tree_lookup(self, name)
+
 class GitTag(GitCommit):
     format = b'tag'
 
+""" PACKFILE FORMAT (version 2)
+ pack: "PACK" [version] [object count] then the objects, then sha-1 of everything before it
+ object: [type + size] varint header followed by the zlib-compressed data
+ idx: 0xff "tOc" [version] [fanout] [sha-1s] [crc32s] [offsets] [large offsets] [pack sha-1] [idx sha-1]
+ fanout = 256 entries, entry i is the number of objects whose first sha byte is <= i
+ """
+
+""" DELTA FORMAT
+ OFS_DELTA: [header] [negative offset of the base in the same pack] [zlib delta]
+ REF_DELTA: [header] [sha-1 of the base] [zlib delta]
+ delta: [base size] [result size] then instructions, sizes as little-endian 7 bit varints
+ copy = 1xxxxxxx followed by up to 4 offset bytes and 3 size bytes (present if their bit is set)
+ insert = 0xxxxxxx followed by that many literal bytes
+ """
+
+PACK_TYPES = {1: b'commit', 2: b'tree', 3: b'blob', 4: b'tag'}
+PACK_TYPE_IDS = {v: k for k, v in PACK_TYPES.items()}
+PACK_OFS_DELTA = 6
+PACK_REF_DELTA = 7
+IDX_SIGNATURE = b'\xfftOc'
+IDX_HEADER_SIZE = 8 + 256*4
+PACK_READ_CHUNK = 8192
+
+#same defaults as git: pack.window, pack.depth and core.deltaBaseCacheLimit
+PACK_WINDOW = 10
+PACK_DEPTH = 50
+DELTA_BASE_CACHE_LIMIT = 96 * 1024 * 1024
+#objects outside these sizes are always stored whole
+DELTA_MIN_SIZE = 64
+DELTA_MAX_SIZE = 64 * 1024 * 1024
+DELTA_BLOCK = 16
+
+class GitPack(object):
+    '''packfile and its .idx, both memory-mapped'''
+    name = None
+    pack = None
+    idx = None
+    count = 0
+
+    def __init__(self, path):
+        #path without extension: objects/pack/pack-<sha>
+        self.name = os.path.basename(path)
+
+        with open(path + ".idx", "rb") as f:
+            self.idx = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        with open(path + ".pack", "rb") as f:
+            self.pack = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if self.idx[0:4] != IDX_SIGNATURE or struct.unpack_from(">I", self.idx, 4)[0] != 2:
+            raise Exception("Unsupported pack index {}.idx".format(path))
+        if self.pack[0:4] != b"PACK":
+            raise Exception("Malformed packfile {}.pack".format(path))
+
+        self.count = struct.unpack_from(">I", self.idx, IDX_HEADER_SIZE - 4)[0]
+
+    def close(self):
+        self.idx.close()
+        self.pack.close()
+
+#Packs are opened once per repository object, newest first
+def repo_packs(repo):
+    if repo.packs is None:
+        packs = list()
+        path = repo_dir(repo, "objects", "pack")
+        if path:
+            names = [f[:-4] for f in os.listdir(path) if f.endswith(".idx")]
+            names = [n for n in names if os.path.isfile(os.path.join(path, n + ".pack"))]
+            names.sort(key=lambda n: os.path.getmtime(os.path.join(path, n + ".idx")), reverse=True)
+            for name in names:
+                packs.append(GitPack(os.path.join(path, name)))
+        repo.packs = packs
+
+    return repo.packs
+
+#Binary search of the idx sha table, restricted by the fanout table to the shas sharing the first byte
+def pack_lookup(pack, binsha):
+    first = binsha[0]
+    lo = struct.unpack_from(">I", pack.idx, 8 + (first-1)*4)[0] if first else 0
+    hi = struct.unpack_from(">I", pack.idx, 8 + first*4)[0]
+
+    while lo < hi:
+        mid = (lo + hi) // 2
+        pos = IDX_HEADER_SIZE + mid*20
+        current = pack.idx[pos:pos+20]
+        if current < binsha:
+            lo = mid + 1
+        elif current > binsha:
+            hi = mid
+        else:
+            return pack_offset(pack, mid)
+
+    return None
+
+#Offset in the pack of the n-th object in the idx
+def pack_offset(pack, n):
+    offsets = IDX_HEADER_SIZE + pack.count*24
+    offset = struct.unpack_from(">I", pack.idx, offsets + n*4)[0]
+
+    #MSB set: the offset is stored in the 8-byte large offsets table
+    if offset & 0x80000000:
+        large = offsets + pack.count*4 + (offset & 0x7fffffff)*8
+        offset = struct.unpack_from(">Q", pack.idx, large)[0]
+
+    return offset
+
+#All the shas stored in the pack (hex), in idx order
+def pack_shas(pack):
+    for n in range(pack.count):
+        pos = IDX_HEADER_SIZE + n*20
+        yield pack.idx[pos:pos+20].hex()
+
+#Returns (pack, offset) for the first pack containing sha or None
+def pack_find(repo, sha):
+    packs = repo_packs(repo)
+    if not packs:
+        return None
+
+    binsha = bytes.fromhex(sha)
+    for pack in packs:
+        offset = pack_lookup(pack, binsha)
+        if offset is not None:
+            return pack, offset
+
+    return None
+
+def pack_read(repo, sha):
+    found = pack_find(repo, sha)
+    if not found:
+        return None
+
+    pack, offset = found
+    return pack_read_at(repo, pack, offset)
+
+#Parses the object header: type in bits 6-4 of the first byte, size in little-endian groups of 4 then 7 bits
+def pack_object_header(data, offset):
+    c = data[offset]
+    type = (c >> 4) & 0b111
+    size = c & 0b1111
+    shift = 4
+    offset += 1
+
+    while c & 0x80:
+        c = data[offset]
+        size |= (c & 0x7f) << shift
+        shift += 7
+        offset += 1
+
+    return type, size, offset
+
+def pack_object_header_encode(type, size):
+    result = bytearray()
+    c = (type << 4) | (size & 0b1111)
+    size >>= 4
+
+    while size:
+        result.append(c | 0x80)
+        c = size & 0x7f
+        size >>= 7
+    result.append(c)
+
+    return bytes(result)
+
+#Inflates the zlib stream starting at offset, reading the pack in small chunks
+#(slicing the whole remainder of the map would copy the rest of the pack)
+def pack_inflate(pack, offset, size):
+    decompressor = zlib.decompressobj()
+    result = list()
+
+    while not decompressor.eof:
+        chunk = pack.pack[offset:offset+PACK_READ_CHUNK]
+        if not chunk:
+            raise Exception("Truncated object in {}".format(pack.name))
+        result.append(decompressor.decompress(chunk))
+        offset += len(chunk)
+
+    data = b''.join(result)
+    if len(data) != size:
+        raise Exception("Malformed object in {0}: bad length".format(pack.name))
+
+    return data
+
+#Inflates the first count bytes of the zlib stream starting at offset (fewer if
+#the stream is shorter), feeding the pack to the decompressor in small chunks
+def pack_inflate_head(pack, offset, count):
+    decompressor = zlib.decompressobj()
+    result = b''
+
+    while len(result) < count and not decompressor.eof:
+        data = decompressor.unconsumed_tail
+        if not data:
+            data = pack.pack[offset:offset+PACK_READ_CHUNK]
+            if not data:
+                raise Exception("Truncated object in {}".format(pack.name))
+            offset += len(data)
+        result += decompressor.decompress(data, count - len(result))
+
+    return result
+
+#Decodes the base offset of an OFS_DELTA, relative to the delta's own offset
+def pack_delta_offset(data, offset):
+    c = data[offset]
+    result = c & 0x7f
+    offset += 1
+
+    while c & 0x80:
+        c = data[offset]
+        result = ((result + 1) << 7) | (c & 0x7f)
+        offset += 1
+
+    return result, offset
+
+def pack_delta_offset_encode(relative):
+    result = bytearray([relative & 0x7f])
+    relative >>= 7
+
+    while relative:
+        relative -= 1
+        result.insert(0, 0x80 | (relative & 0x7f))
+        relative >>= 7
+
+    return bytes(result)
+
+def pack_read_at(repo, pack, offset):
+    #Walking down the delta chain (without recursion, chains can be long)
+    #until a whole object or an already resolved base is found
+    chain = list()
+    base_key = None
+
+    while True:
+        base = repo.delta_cache.get((pack.name, offset))
+        if base is not None:
+            break
+
+        type, size, data_offset = pack_object_header(pack.pack, offset)
+
+        if type in PACK_TYPES:
+            base = PACK_TYPES[type], pack_inflate(pack, data_offset, size)
+            base_key = (pack.name, offset)
+            break
+        elif type == PACK_OFS_DELTA:
+            relative, data_offset = pack_delta_offset(pack.pack, data_offset)
+            chain.append((offset, pack_inflate(pack, data_offset, size)))
+            offset -= relative
+        elif type == PACK_REF_DELTA:
+            base_sha = pack.pack[data_offset:data_offset+20]
+            chain.append((offset, pack_inflate(pack, data_offset+20, size)))
+            offset = pack_lookup(pack, base_sha)
+            if offset is None:
+                #base stored outside this pack
+                base = object_read_raw(repo, base_sha.hex())
+                if base is None:
+                    raise Exception("Missing delta base {0} in {1}".format(base_sha.hex(), pack.name))
+                break
+        else:
+            raise Exception("Unknown pack object type {0} in {1}".format(type, pack.name))
+
+    format, data = base
+    if chain and base_key:
+        repo.delta_cache.put(base_key, base, len(data))
+
+    #Applying the deltas from the base up, every intermediate result is itself a base
+    for (n, (delta_offset, delta)) in enumerate(reversed(chain)):
+        data = delta_apply(data, delta)
+        if n < len(chain) - 1:
+            repo.delta_cache.put((pack.name, delta_offset), (format, data), len(data))
+
+    return format, data
+
+def pack_read_stream(repo, pack, offset):
+    type, size, data_offset = pack_object_header(pack.pack, offset)
+
+    #deltas need their base, they are resolved in memory
+    if type not in PACK_TYPES:
+        format, data = pack_read_at(repo, pack, offset)
+        chunks = (data[i:i+OBJECT_STREAM_CHUNK] for i in range(0, len(data), OBJECT_STREAM_CHUNK))
+        return format, len(data), chunks
+
+    def read(n):
+        nonlocal data_offset
+        data = pack.pack[data_offset:data_offset+n]
+        data_offset += len(data)
+        return data
+
+    return PACK_TYPES[type], size, object_stream_body(b'', zlib_inflate_chunks(read, pack.name), size, pack.name)
+
+#Returns (format, size) without inflating the whole object
+def pack_read_header_at(repo, pack, offset):
+    size = None
+
+    while True:
+        type, delta_size, data_offset = pack_object_header(pack.pack, offset)
+
+        if type in PACK_TYPES:
+            return PACK_TYPES[type], delta_size if size is None else size
+
+        if type == PACK_OFS_DELTA:
+            relative, data_offset = pack_delta_offset(pack.pack, data_offset)
+            base_offset = offset - relative
+        elif type == PACK_REF_DELTA:
+            base_sha = pack.pack[data_offset:data_offset+20]
+            data_offset += 20
+            base_offset = pack_lookup(pack, base_sha)
+        else:
+            raise Exception("Unknown pack object type {0} in {1}".format(type, pack.name))
+
+        #the object's size is the result size at the start of its delta, its type is the base's type
+        if size is None:
+            head = pack_inflate_head(pack, data_offset, 20)
+            _, pos = delta_varint(head, 0)
+            size, _ = delta_varint(head, pos)
+
+        if base_offset is None:
+            return object_read_header(repo, base_sha.hex())[0], size
+        offset = base_offset
+
+def delta_varint(data, pos):
+    result = 0
+    shift = 0
+
+    while True:
+        c = data[pos]
+        result |= (c & 0x7f) << shift
+        shift += 7
+        pos += 1
+        if not c & 0x80:
+            return result, pos
+
+def delta_varint_encode(value):
+    result = bytearray()
+
+    while value >= 0x80:
+        result.append(0x80 | (value & 0x7f))
+        value >>= 7
+    result.append(value)
+
+    return bytes(result)
+
+def delta_apply(base, delta):
+    base_size, pos = delta_varint(delta, 0)
+    if base_size != len(base):
+        raise Exception("Malformed delta: bad base length")
+    size, pos = delta_varint(delta, pos)
+
+    result = bytearray()
+    end = len(delta)
+
+    while pos < end:
+        c = delta[pos]
+        pos += 1
+
+        if c & 0x80: #copy from base
+            copy_offset = 0
+            copy_size = 0
+            for i in range(4):
+                if c & (1 << i):
+                    copy_offset |= delta[pos] << (8*i)
+                    pos += 1
+            for i in range(3):
+                if c & (0x10 << i):
+                    copy_size |= delta[pos] << (8*i)
+                    pos += 1
+            if copy_size == 0:
+                copy_size = 0x10000
+            result += base[copy_offset:copy_offset+copy_size]
+        elif c: #insert literal bytes
+            result += delta[pos:pos+c]
+            pos += c
+        else:
+            raise Exception("Malformed delta: unknown instruction")
+
+    if len(result) != size:
+        raise Exception("Malformed delta: bad result length")
+
+    return bytes(result)
+
+#Index of the base for delta_create: every aligned block of the base mapped to its offset
+def delta_index(base):
+    index = dict()
+    for offset in range(0, len(base) - DELTA_BLOCK + 1, DELTA_BLOCK):
+        index.setdefault(base[offset:offset+DELTA_BLOCK], offset)
+    return index
+
+#Returns the delta turning base into target, or None if it is bigger than max_size
+def delta_create(base, index, target, max_size):
+    result = bytearray(delta_varint_encode(len(base)) + delta_varint_encode(len(target)))
+
+    end = len(target)
+    pos = 0
+    pending = 0 #start of the bytes not yet copied or inserted
+
+    while pos <= end - DELTA_BLOCK:
+        base_offset = index.get(target[pos:pos+DELTA_BLOCK])
+        if base_offset is None:
+            pos += 1
+            #the pending bytes will be inserted as they are: give up as soon as they don't fit
+            if len(result) + pos - pending > max_size:
+                return None
+            continue
+
+        #extending the match backwards into the pending bytes, then forwards
+        while pos > pending and base_offset > 0 and base[base_offset-1] == target[pos-1]:
+            pos -= 1
+            base_offset -= 1
+        length = delta_match_length(base, base_offset, target, pos)
+
+        delta_insert(result, target, pending, pos)
+        delta_copy(result, base_offset, length)
+        pos += length
+        pending = pos
+
+        if len(result) > max_size:
+            return None
+
+    delta_insert(result, target, pending, end)
+
+    if len(result) > max_size:
+        return None
+    return bytes(result)
+
+def delta_match_length(base, base_offset, target, target_offset):
+    limit = min(len(base) - base_offset, len(target) - target_offset)
+    length = 0
+
+    #comparing whole blocks first, then byte by byte
+    step = 256
+    while length + step <= limit and base[base_offset+length:base_offset+length+step] == target[target_offset+length:target_offset+length+step]:
+        length += step
+    while length < limit and base[base_offset+length] == target[target_offset+length]:
+        length += 1
+
+    return length
+
+def delta_insert(result, target, start, end):
+    while start < end:
+        size = min(end - start, 0x7f)
+        result.append(size)
+        result += target[start:start+size]
+        start += size
+
+def delta_copy(result, offset, size):
+    while size:
+        #copies are limited to 0x10000 bytes, as git does
+        copy_size = min(size, 0x10000)
+        instruction = bytearray([0x80])
+
+        for i in range(4):
+            byte = (offset >> (8*i)) & 0xff
+            if byte:
+                instruction[0] |= 1 << i
+                instruction.append(byte)
+        for i in range(3):
+            byte = (copy_size >> (8*i)) & 0xff
+            if byte:
+                instruction[0] |= 0x10 << i
+                instruction.append(byte)
+
+        result += instruction
+        offset += copy_size
+        size -= copy_size
+
+#Shas in the pack starting with the hex prefix (at least 2 chars)
+def pack_resolve_prefix(pack, prefix):
+    first = int(prefix[0:2], 16)
+    lo = struct.unpack_from(">I", pack.idx, 8 + (first-1)*4)[0] if first else 0
+    hi = struct.unpack_from(">I", pack.idx, 8 + first*4)[0]
+
+    result = list()
+    for n in range(lo, hi):
+        pos = IDX_HEADER_SIZE + n*20
+        sha = pack.idx[pos:pos+20].hex()
+        if sha.startswith(prefix):
+            result.append(sha)
+
+    return result
+
+#Every object in the repository, loose and packed (hex shas)
+def object_list(repo):
+    result = set(object_list_loose(repo))
+
+    for pack in repo_packs(repo):
+        result.update(pack_shas(pack))
+
+    return result
+
+def object_list_loose(repo):
+    path = repo_dir(repo, "objects")
+    hexRE = re.compile(r"[0-9a-f]{2}$")
+
+    for prefix in os.listdir(path):
+        if not hexRE.match(prefix):
+            continue
+        for file in os.listdir(os.path.join(path, prefix)):
+            yield prefix + file
+
+#Order in which objects are written and considered for deltas, like git: objects are
+#grouped by type and file name, biggest first so that bases come before their deltas
+def pack_sort(repo, shas):
+    headers = dict()
+    names = dict()
+
+    for sha in shas:
+        headers[sha] = object_read_header(repo, sha)
+
+    #name hints for blobs and trees, taken from the trees pointing to them
+    for sha in shas:
+        if headers[sha][0] == b'tree':
+            for leaf in object_read(repo, sha).items:
+                names.setdefault(leaf.sha, leaf.path)
+
+    def key(sha):
+        format, size = headers[sha]
+        return PACK_TYPE_IDS[format], names.get(sha, ""), -size
+
+    return sorted(shas, key=key)
+
+#Writes the given objects in a new pack + idx, returns the pack name
+def pack_write(repo, shas):
+    pack_dir = repo_dir(repo, "objects", "pack", mkdir=True)
+    tmp_path = os.path.join(pack_dir, "tmp_pack_{}".format(os.getpid()))
+
+    #(binary sha, crc32, offset) for every object, used to build the idx
+    entries = list()
+    checksum = hashlib.sha1()
+
+    #the last objects written, candidate bases as (format, data, delta index, depth, offset)
+    window = collections.deque(maxlen=PACK_WINDOW)
+
+    try:
+        with open(tmp_path, "wb") as f:
+            header = b"PACK" + struct.pack(">II", 2, len(shas))
+            f.write(header)
+            checksum.update(header)
+            offset = len(header)
+
+            for sha in pack_sort(repo, shas):
+                format, data = object_read_raw(repo, sha)
+
+                depth = 0
+                best = None
+                if DELTA_MIN_SIZE <= len(data) <= DELTA_MAX_SIZE:
+                    #a delta is only worth it when it is at most half the object
+                    max_size = len(data) // 2 - 20
+                    for (base_format, base, index, base_depth, base_offset) in window:
+                        if base_format != format or base_depth >= PACK_DEPTH or len(data) < len(base) // 32:
+                            continue
+                        delta = delta_create(base, index, data, max_size)
+                        if delta is not None:
+                            best = (delta, base_depth, base_offset)
+                            max_size = len(delta) - 1
+
+                if best:
+                    delta, base_depth, base_offset = best
+                    depth = base_depth + 1
+                    record = (pack_object_header_encode(PACK_OFS_DELTA, len(delta)) +
+                              pack_delta_offset_encode(offset - base_offset) +
+                              zlib.compress(delta))
+                else:
+                    record = pack_object_header_encode(PACK_TYPE_IDS[format], len(data)) + zlib.compress(data)
+
+                entries.append((bytes.fromhex(sha), zlib.crc32(record), offset))
+
+                if DELTA_MIN_SIZE <= len(data) <= DELTA_MAX_SIZE:
+                    window.append((format, data, delta_index(data), depth, offset))
+
+                f.write(record)
+                checksum.update(record)
+                offset += len(record)
+
+            trailer = checksum.digest()
+            f.write(trailer)
+            f.flush()
+            os.fsync(f.fileno())
+
+        name = "pack-" + trailer.hex()
+        path = os.path.join(pack_dir, name)
+        os.replace(tmp_path, path + ".pack")
+
+        #the idx is written last, a pack is only visible once its idx exists
+        with open(tmp_path, "wb") as f:
+            f.write(idx_serialize(entries, trailer))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path + ".idx")
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+
+    #the renames are made durable too: repack deletes the objects the pack replaces
+    fd = os.open(pack_dir, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+    return name
+
+def idx_serialize(entries, pack_checksum):
+    entries = sorted(entries)
+    count = len(entries)
+
+    fanout = [0] * 256
+    for (binsha, _, _) in entries:
+        fanout[binsha[0]] += 1
+    for i in range(1, 256):
+        fanout[i] += fanout[i-1]
+
+    offsets = list()
+    large_offsets = list()
+    for (_, _, offset) in entries:
+        if offset < 0x80000000:
+            offsets.append(offset)
+        else:
+            offsets.append(0x80000000 | len(large_offsets))
+            large_offsets.append(offset)
+
+    result = [IDX_SIGNATURE,
+              struct.pack(">I", 2),
+              struct.pack(">256I", *fanout),
+              b''.join(binsha for (binsha, _, _) in entries),
+              struct.pack(">{}I".format(count), *(crc for (_, crc, _) in entries)),
+              struct.pack(">{}I".format(count), *offsets),
+              struct.pack(">{}Q".format(len(large_offsets)), *large_offsets),
+              pack_checksum]
+    data = b''.join(result)
+
+    return data + hashlib.sha1(data).digest()
+
+#Packs every object of the repository into a single pack, then removes
+#the old packs and the loose objects it replaces
+def repack(repo):
+    loose = list(object_list_loose(repo))
+    shas = sorted(object_list(repo))
+
+    if not shas:
+        return None
+
+    old_packs = repo_packs(repo)
+    name = pack_write(repo, shas)
+
+    pack_dir = repo_dir(repo, "objects", "pack")
+    for pack in old_packs:
+        if pack.name == name:
+            continue
+        pack.close()
+        for ext in (".pack", ".idx"):
+            os.unlink(os.path.join(pack_dir, pack.name + ext))
+
+    for sha in loose:
+        os.unlink(repo_file(repo, "objects", sha[0:2], sha[2:]))
+        try:
+            os.rmdir(repo_dir(repo, "objects", sha[0:2]))
+        except OSError:
+            pass #directory still holds objects
+
+    repo.packs = None
+    return name
+
 #Path in repo's gitdir
 def repo_path(repo, *path):
     return os.path.join(repo.gitdir, *path)
@@ -246,7 +1273,8 @@ def repo_dir(repo, *path, mkdir=False):
             raise Exception("Not a directory %s" % path)
     
     if mkdir:
-        os.makedirs(path)
+        #exist_ok: the directory may be created concurrently by another thread
+        os.makedirs(path, exist_ok=True)
         return path
     else:
         return None
@@ -323,14 +1351,15 @@ def object_find(repo, name, format=None, follow = True):
         return sha
 
     while True:
-        obj = object_read(repo, sha)
-
-        if obj.format == format:
+        #only the header is needed to check the type, blobs may be big
+        if object_read_header(repo, sha)[0] == format:
             return sha
 
         if not follow:
             return None
 
+        obj = object_read(repo, sha)
+
         if obj.format == b'tag':
             sha = obj.keyvaluelist[b'object'].decode("ascii")
         elif obj.format == b'commit' and format == b'tree':
@@ -358,6 +1387,11 @@ def object_resolve(repo, name):
                 if file.startswith(remainder):
                     candidates.append(prefix + file)
 
+        for pack in repo_packs(repo):
+            for sha in pack_resolve_prefix(pack, name):
+                if sha not in candidates:
+                    candidates.append(sha)
+
     as_tag = ref_resolve(repo, "refs/tags/" + name)
     if as_tag:
         candidates.append(as_tag)
@@ -369,7 +1403,16 @@ def object_resolve(repo, name):
     return candidates
 
 def cat_file(repo, object, format=None):
-    object = object_read(repo, object_find(repo, object, format=format))
+    sha = object_find(repo, object, format=format)
+
+    #blobs are copied to stdout as they are inflated
+    if format == b'blob':
+        _, _, body = object_read_stream(repo, sha)
+        for chunk in body:
+            sys.stdout.buffer.write(chunk)
+        return
+
+    object = object_read(repo, sha)
     sys.stdout.buffer.write(object.serialize())
 
 def object_hash(file, format, repo=None):
@@ -384,92 +1427,681 @@ def object_hash(file, format, repo=None):
 
     return object_write(obj, repo)
 
-def keyvaluelist_parse(raw, start=0, dct=None):
+#Hashes a file as a blob (and writes it, if repo) in constant memory:
+#the header is built from the file size, then the data is read in chunks
+#Hashing is cheap next to compressing: with repo, the file is read a second
+#time and compressed only when its object is not stored yet
+def object_hash_file(path, repo=None):
+    with open(path, "rb") as file:
+        size = os.fstat(file.fileno()).st_size
+
+        sha = hashlib.sha1()
+        for chunk in object_stream_chunks(b'blob', size, file, path):
+            sha.update(chunk)
+        sha = sha.hexdigest()
+
+        if repo and not object_exists(repo, sha):
+            file.seek(0)
+            #the sha of what is actually written, should the file change in between
+            sha = object_write_loose(repo, object_stream_chunks(b'blob', size, file, path))
+
+        return sha
+
+def object_stream_chunks(format, size, file, path):
+    yield format + b' ' + str(size).encode() + b'\x00'
+
+    remaining = size
+    while remaining > 0:
+        chunk = file.read(min(remaining, OBJECT_STREAM_CHUNK))
+        if not chunk:
+            break
+        remaining -= len(chunk)
+        yield chunk
+
+    if remaining or file.read(1):
+        raise Exception("File {} changed while being hashed".format(path))
+
+#end of a header value: the first newline not followed by a space (continuation lines start with a space)
+keyvaluelistEndRE = re.compile(rb"\n(?! )")
+
+#With keys, only those headers are kept and parsing stops at the first other header
+#once all of them were found (history walks only need tree and parent).
+#message=False leaves the message out instead of copying it.
+def keyvaluelist_parse(raw, start=0, dct=None, keys=None, message=True):
     
     if not dct:
         dct = collections.OrderedDict()
 
-    space = raw.find(b' ', start)
-    newline = raw.find(b'\n', start)
+    missing = set(keys) if keys is not None else None
 
-    # Baseline case: Blank line | final message
-    # The remainder of the data is the message => stored in dictionary with None key and returned 
-    if (space < 0) or (newline < space):
-        assert newline == start
-        dct[None] =raw[start+1:]
-        return dct
-
-    #key
-    key = raw[start:space]
-
-    #finding the end of value (continuation lines start with a space)
-    end = start
     while True:
-        end = raw.find(b'\n', end+1)
-        if raw[end+1] != ord(' '): break
+        space = raw.find(b' ', start)
+        newline = raw.find(b'\n', start)
+
+        # Blank line | final message
+        # The remainder of the data is the message => stored in dictionary with None key
+        if (space < 0) or (newline < space):
+            assert newline == start
+            if message:
+                dct[None] = raw[start+1:]
+            return dct
+
+        #key
+        key = raw[start:space]
+        wanted = keys is None or key in keys
+        if not wanted and not missing:
+            return dct
+
+        #finding the end of value
+        match = keyvaluelistEndRE.search(raw, space)
+        end = match.start() if match else len(raw)
+        start = end + 1
+
+        if not wanted:
+            continue
+        if missing:
+            missing.discard(key)
 
-    value = raw[space+1:end].replace(b'\n ', b'\n')
+        value = raw[space+1:end].replace(b'\n ', b'\n')
 
-    #Not overwriting existing content
-    if key in dct:
-        if type(dct[key]) == list:
-            dct[key].append(value)
+        #Not overwriting existing content
+        if key in dct:
+            if type(dct[key]) == list:
+                dct[key].append(value)
+            else:
+                dct[key] = [ dct[key], value ]
+            
         else:
-            dct[key] = [ dct[key], value ]
-        
-    else:
-        dct[key] = value
-
-    return keyvaluelist_parse(raw, start=end+1, dct=dct)
+            dct[key] = value
 
 def keyvaluelist_serialize(keyvaluelist):
-    result = b''
+    result = list()
 
-    for key in keyvaluelist.keys():
+    for (key, value) in keyvaluelist.items():
         if key == None: continue
-        value = keyvaluelist[key]
 
         if type(value) != list:
             value = [ value ]
         
         for v in value:
-            result += key + b' ' + (v.replace(b'\n', b'\n ')) + b'\n'
+            result.append(key + b' ' + (v.replace(b'\n', b'\n ')) + b'\n')
+
+    result.append(b'\n' + keyvaluelist[None] + b'\n')
+
+    return b''.join(result)
+
+""" COMMIT-GRAPH FORMAT (objects/info/commit-graph), same format as git
+ "CGPH" [version = 1] [hash version = 1 (sha-1)] [chunk count] [base graph count = 0]
+ chunk table: [4 byte id] [8 byte offset] per chunk, then a zero id with the end offset of the last chunk
+ OIDF: fanout, as in the pack idx
+ OIDL: sha-1s of the commits, sorted
+ CDAT: per commit [tree sha-1] [parent 1] [parent 2] [generation (30 bits) + committer date (34 bits)]
+ parents are positions in OIDL, 0x70000000 for none; for octopus merges parent 2 is
+ 0x80000000 | position in EDGE of the other parents, the last of them or-ed with 0x80000000
+ generation = 1 for root commits, 1 + the highest generation of the parents otherwise
+ then sha-1 of everything before it
+ """
 
-    result += b'\n' + keyvaluelist[None] + b'\n'
+COMMIT_GRAPH_SIGNATURE = b'CGPH'
+COMMIT_GRAPH_NO_PARENT = 0x70000000
+COMMIT_GRAPH_EDGE = 0x80000000
+COMMIT_GRAPH_DATA_SIZE = 20 + 16
+COMMIT_GRAPH_MAX_GENERATION = 0x3fffffff
+#generation of the commits missing from the commit-graph: they can only be newer
+GENERATION_INFINITY = 0xffffffff
+
+class GitCommitGraph(object):
+    '''objects/info/commit-graph, memory-mapped'''
+    data = None
+    count = 0
+    #offsets of the OIDF, OIDL, CDAT and EDGE chunks
+    fanout = None
+    oids = None
+    commits = None
+    edges = None
+
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if self.data[0:4] != COMMIT_GRAPH_SIGNATURE or self.data[4:6] != b'\x01\x01' or self.data[7] != 0:
+            raise Exception("Unsupported commit-graph {}".format(path))
+
+        chunks = dict()
+        for i in range(self.data[6]):
+            id, offset = struct.unpack_from(">4sQ", self.data, 8 + i*12)
+            chunks[id] = offset
+
+        if not all(id in chunks for id in (b'OIDF', b'OIDL', b'CDAT')):
+            raise Exception("Malformed commit-graph {}".format(path))
+
+        self.fanout = chunks[b'OIDF']
+        self.oids = chunks[b'OIDL']
+        self.commits = chunks[b'CDAT']
+        self.edges = chunks.get(b'EDGE')
+        self.count = struct.unpack_from(">I", self.data, self.fanout + 255*4)[0]
+
+    def close(self):
+        self.data.close()
+
+#The commit-graph is opened once per repository object, None if there is none
+def repo_commit_graph(repo):
+    if repo.commit_graph is None:
+        path = repo_file(repo, "objects", "info", "commit-graph")
+        repo.commit_graph = GitCommitGraph(path) if path and os.path.isfile(path) else False
+
+    return repo.commit_graph or None
+
+#Position of binsha in the commit-graph or None, searched as in pack_lookup
+def commit_graph_lookup(graph, binsha):
+    first = binsha[0]
+    lo = struct.unpack_from(">I", graph.data, graph.fanout + (first-1)*4)[0] if first else 0
+    hi = struct.unpack_from(">I", graph.data, graph.fanout + first*4)[0]
+
+    while lo < hi:
+        mid = (lo + hi) // 2
+        pos = graph.oids + mid*20
+        current = graph.data[pos:pos+20]
+        if current < binsha:
+            lo = mid + 1
+        elif current > binsha:
+            hi = mid
+        else:
+            return mid
 
-    return result
+    return None
 
-def log_graphviz(repo, sha , seen):
-    if sha in seen:
-        return
-    seen.add(sha)
+def commit_graph_sha(graph, n):
+    pos = graph.oids + n*20
+    return graph.data[pos:pos+20].hex()
+
+#Returns (parent positions, committer date, generation) of the n-th commit
+def commit_graph_commit(graph, n):
+    parent1, parent2, high, low = struct.unpack_from(">IIII", graph.data, graph.commits + n*COMMIT_GRAPH_DATA_SIZE + 20)
+
+    parents = list()
+    if parent1 != COMMIT_GRAPH_NO_PARENT:
+        parents.append(parent1)
+
+    if parent2 & COMMIT_GRAPH_EDGE:
+        pos = graph.edges + (parent2 & ~COMMIT_GRAPH_EDGE)*4
+        while True:
+            parent = struct.unpack_from(">I", graph.data, pos)[0]
+            parents.append(parent & ~COMMIT_GRAPH_EDGE)
+            if parent & COMMIT_GRAPH_EDGE:
+                break
+            pos += 4
+    elif parent2 != COMMIT_GRAPH_NO_PARENT:
+        parents.append(parent2)
+
+    return parents, (high & 0x3) << 32 | low, high >> 2
+
+#Headers of a commit, parsed until all keys are found. Loose commits are
+#inflated only up to the end of their headers.
+def commit_headers(repo, sha, keys):
+    commit = repo.object_cache.get(sha)
+    if commit is not None:
+        return commit.keyvaluelist
+
+    raw = pack_read(repo, sha)
+    if raw is None:
+        stream = object_read_stream_loose(repo, sha)
+        if stream is None:
+            raise Exception("No such commit {}".format(sha))
+        format, _, body = stream
+        data = b''
+        for chunk in body:
+            data += chunk
+            if b'\n\n' in data:
+                break
+        body.close()
+        raw = (format, data)
+
+    format, data = raw
+    if format != b'commit':
+        raise Exception("Not a commit {}".format(sha))
+
+    return keyvaluelist_parse(data, keys=keys, message=False)
+
+#Returns (parents, committer date, generation) of a commit, from the commit-graph
+#when it has the commit, GENERATION_INFINITY is the generation of the others
+def commit_info(repo, sha):
+    graph = repo_commit_graph(repo)
+    if graph:
+        n = commit_graph_lookup(graph, bytes.fromhex(sha))
+        if n is not None:
+            parents, date, generation = commit_graph_commit(graph, n)
+            return [commit_graph_sha(graph, parent) for parent in parents], date, generation
+
+    headers = commit_headers(repo, sha, (b'parent', b'committer'))
+
+    parents = headers.get(b'parent', [])
+    if type(parents) != list:
+        parents = [ parents ]
+    date = int(headers[b'committer'].rsplit(b' ', 2)[1])
+
+    return [parent.decode("ascii") for parent in parents], date, GENERATION_INFINITY
+
+#Commits pointed to by HEAD and the refs, tags peeled
+def commit_graph_tips(repo):
+    shas = [ref_resolve(repo, "HEAD")]
+    stack = [ref_list(repo)]
+    while stack:
+        for value in stack.pop().values():
+            if type(value) == str:
+                shas.append(value)
+            else:
+                stack.append(value)
+
+    tips = set()
+    for sha in shas:
+        if sha:
+            sha = object_find(repo, sha, b'commit')
+        if sha:
+            tips.add(sha)
+
+    return tips
+
+#Writes the commit-graph of every commit reachable from HEAD and the refs,
+#returns the number of commits in it
+def commit_graph_write(repo):
+    #sha => (tree, parents, committer date)
+    commits = dict()
+    stack = list(commit_graph_tips(repo))
+    while stack:
+        sha = stack.pop()
+        if sha in commits:
+            continue
 
-    commit = object_read(repo, sha)
-    short_hash = sha[0:8]
-    message = commit.keyvaluelist[None].decode("utf8").strip()
-    message = message.replace("\\", "\\\\")
-    message = message.replace("\"", "\\\"")
+        headers = commit_headers(repo, sha, (b'tree', b'parent', b'committer'))
+        parents = headers.get(b'parent', [])
+        if type(parents) != list:
+            parents = [ parents ]
+        parents = [parent.decode("ascii") for parent in parents]
+        date = int(headers[b'committer'].rsplit(b' ', 2)[1])
+
+        commits[sha] = (headers[b'tree'].decode("ascii"), parents, date)
+        stack.extend(parent for parent in parents if parent not in commits)
+
+    #parents first, without recursion: a commit stays on the stack until its parents are done
+    generations = dict()
+    for sha in commits:
+        stack = [sha]
+        while stack:
+            current = stack[-1]
+            if current in generations:
+                stack.pop()
+                continue
+
+            parents = commits[current][1]
+            missing = [parent for parent in parents if parent not in generations]
+            if missing:
+                stack.extend(missing)
+                continue
+
+            generation = 1 + max((generations[parent] for parent in parents), default=0)
+            generations[current] = min(generation, COMMIT_GRAPH_MAX_GENERATION)
+            stack.pop()
+
+    shas = sorted(commits)
+    positions = {sha: n for (n, sha) in enumerate(shas)}
+
+    fanout = [0] * 256
+    for sha in shas:
+        fanout[int(sha[0:2], 16)] += 1
+    for i in range(1, 256):
+        fanout[i] += fanout[i-1]
+
+    data = list()
+    edges = list()
+    for sha in shas:
+        tree, parents, date = commits[sha]
+        parents = [positions[parent] for parent in parents]
+
+        parent1 = parents[0] if parents else COMMIT_GRAPH_NO_PARENT
+        if len(parents) > 2:
+            parent2 = COMMIT_GRAPH_EDGE | len(edges)
+            edges.extend(parents[1:])
+            edges[-1] |= COMMIT_GRAPH_EDGE
+        elif len(parents) == 2:
+            parent2 = parents[1]
+        else:
+            parent2 = COMMIT_GRAPH_NO_PARENT
+
+        date &= 0x3ffffffff
+        data.append(bytes.fromhex(tree) +
+                    struct.pack(">IIII", parent1, parent2, generations[sha] << 2 | date >> 32, date & 0xffffffff))
+
+    chunks = [(b'OIDF', struct.pack(">256I", *fanout)),
+              (b'OIDL', b''.join(bytes.fromhex(sha) for sha in shas)),
+              (b'CDAT', b''.join(data))]
+    if edges:
+        chunks.append((b'EDGE', struct.pack(">{}I".format(len(edges)), *edges)))
+
+    result = [COMMIT_GRAPH_SIGNATURE, bytes([1, 1, len(chunks), 0])]
+    offset = 8 + (len(chunks) + 1)*12
+    for (id, chunk) in chunks:
+        result.append(struct.pack(">4sQ", id, offset))
+        offset += len(chunk)
+    result.append(struct.pack(">4sQ", b'\x00' * 4, offset))
+    result.extend(chunk for (_, chunk) in chunks)
+    result = b''.join(result)
+
+    path = repo_file(repo, "objects", "info", "commit-graph", mkdir=True)
+    fd, tmp_path = tempfile.mkstemp(prefix="tmp_graph_", dir=os.path.dirname(path))
+    with os.fdopen(fd, "wb") as f:
+        f.write(result)
+        f.write(hashlib.sha1(result).digest())
+    os.chmod(tmp_path, 0o444)
+    os.replace(tmp_path, path)
+
+    if repo.commit_graph:
+        repo.commit_graph.close()
+    repo.commit_graph = None
+
+    return len(shas)
+
+""" REVISION WALK
+ Commits are taken newest first (committer date) from a priority queue, parents are
+ queued as their children are taken: the history is never held whole, only the
+ commits queued and the set of commits seen.
+ Commits reachable from an excluded commit (^A, A..B) are uninteresting: they are
+ walked (and their parents marked uninteresting too) but not returned. Committer
+ dates can be skewed, so such a walk is limited first: it is run to its end
+ before any commit is returned (see revwalk_limit).
+ """
 
-    # Print first line only
-    if "\n" in message:
-        message = message[:message.index("\n")]
+#uninteresting commits taken after the last sign that the walk may not be over
+REVWALK_SLOP = 5
+
+class GitRevWalk(object):
+    '''state of a history walk (see revwalk_push, revwalk_next)'''
+    #heap of (-committer date, push order, sha, parents): newest first, ties in push order
+    queue = None
+    #sha => True if uninteresting, for every commit queued or taken
+    flags = None
+    #commits known to be uninteresting before being queued
+    marked = None
+    #interesting commits in the queue
+    interesting = 0
+    #parents of the commits queued or taken, and the commits taken, kept only when
+    #some commits are excluded: they may become uninteresting after being taken
+    parents = None
+    taken = None
+    limited = False
+    #commits left to return once a limited walk is done (see revwalk_limit)
+    result = None
+    first_parent = False
+    order = 0
+
+    def __init__(self, repo, first_parent=False):
+        self.repo = repo
+        self.first_parent = first_parent
+        self.queue = list()
+        self.flags = dict()
+        self.marked = set()
+        self.parents = dict()
+        self.taken = set()
+
+#Queues sha unless it was already seen. Like git, the parents of an uninteresting
+#commit are marked uninteresting as soon as it is queued, not when it is taken.
+def revwalk_push(walk, sha, uninteresting=False):
+    if sha not in walk.flags:
+        parents, date, _ = commit_info(walk.repo, sha)
+        flag = uninteresting or sha in walk.marked
+        walk.flags[sha] = flag
+        walk.marked.discard(sha)
+        if uninteresting:
+            walk.limited = True
+        if not flag:
+            walk.interesting += 1
+        if walk.limited:
+            walk.parents[sha] = parents
+
+        heapq.heappush(walk.queue, (-date, walk.order, sha, parents))
+        walk.order += 1
+    elif uninteresting and not walk.flags[sha]:
+        walk.flags[sha] = True
+        if sha not in walk.taken:
+            walk.interesting -= 1
+
+    if uninteresting:
+        revwalk_mark_parents_uninteresting(walk, sha)
+
+#Marks the parents of sha uninteresting, and the commits below them as far as they
+#were seen: commits not seen yet are only remembered (walk.marked)
+def revwalk_mark_parents_uninteresting(walk, sha):
+    stack = [sha]
+    while stack:
+        sha = stack.pop()
+        parents = walk.parents.get(sha)
+        if parents is None:
+            #queued before the walk became limited
+            parents, _, _ = commit_info(walk.repo, sha)
+
+        for parent in parents:
+            flag = walk.flags.get(parent)
+            if flag is None:
+                walk.marked.add(parent)
+            elif not flag:
+                walk.flags[parent] = True
+                if parent not in walk.taken:
+                    walk.interesting -= 1
+                stack.append(parent)
+
+#Revisions as in git log: A, ^A (excluded) and A..B (B but not A, either defaults to HEAD)
+def revwalk_push_revision(walk, name):
+    if ".." in name:
+        exclude, include = name.split("..", 1)
+        revwalk_push(walk, object_find(walk.repo, exclude or "HEAD", b'commit'), True)
+        revwalk_push(walk, object_find(walk.repo, include or "HEAD", b'commit'))
+    elif name.startswith("^"):
+        revwalk_push(walk, object_find(walk.repo, name[1:], b'commit'), True)
+    else:
+        revwalk_push(walk, object_find(walk.repo, name, b'commit'))
 
-    print(" c_{0} [label=\"{1}: {2}\"]".format(sha, sha[0:7], message))
-    assert commit.format==b'commit'
+#Returns the next commit of the walk, None at the end
+def revwalk_next(walk):
+    if walk.limited:
+        if walk.result is None:
+            revwalk_limit(walk)
+        return walk.result.popleft() if walk.result else None
 
-    #initial commit check
-    if not b'parent' in commit.keyvaluelist.keys():
-        return
-    
-    parents = commit.keyvaluelist[b'parent']
+    if not walk.queue:
+        return None
 
-    if type(parents) != list:
-        parents = [ parents ]
+    _, _, sha, parents = heapq.heappop(walk.queue)
+    walk.interesting -= 1
+    for parent in parents[:1] if walk.first_parent else parents:
+        revwalk_push(walk, parent)
+    return sha
+
+#Takes the commits of a limited walk (some commits are excluded) until the excluded
+#ones cannot reach the others anymore, as git's limit_list: a commit is only known
+#to be interesting once the walk is over, older commits may reach it through an
+#uninteresting commit with a skewed date. The walk goes on while an interesting
+#commit is queued or older than the newest commit queued, then for REVWALK_SLOP
+#more uninteresting commits.
+def revwalk_limit(walk):
+    result = list()
+    date = float("inf") #of the last interesting commit taken
+    slop = REVWALK_SLOP
+
+    while walk.queue:
+        key, _, sha, parents = heapq.heappop(walk.queue)
+        walk.taken.add(sha)
+
+        if walk.flags[sha]:
+            for parent in parents:
+                revwalk_push(walk, parent, True)
+
+            if not walk.queue:
+                break
+            if walk.interesting > 0 or date <= -walk.queue[0][0]:
+                slop = REVWALK_SLOP
+            else:
+                slop -= 1
+                if slop == 0:
+                    break
+            continue
+
+        walk.interesting -= 1
+        for parent in parents[:1] if walk.first_parent else parents:
+            revwalk_push(walk, parent)
+        date = -key
+        result.append(sha)
+
+    #commits found uninteresting after being taken are left out
+    walk.result = collections.deque(sha for sha in result if not walk.flags[sha])
+
+#Yields the commits of the walk, at most max_count of them
+def revwalk(walk, max_count=None):
+    count = 0
+    while max_count is None or count < max_count:
+        sha = revwalk_next(walk)
+        if sha is None:
+            return
+        yield sha
+        count += 1
+
+""" MERGE BASES
+ Commits are painted from both sides, highest generation first then newest first:
+ a commit painted from both sides is a common ancestor and the commits below it
+ are stale. The walk is over when only stale commits are left in the queue.
+ With a commit-graph, generations order the walk so that no commit is taken
+ before its descendants; commits missing from it come first (GENERATION_INFINITY).
+ """
+
+MERGE_BASE_ONE = 1
+MERGE_BASE_TWO = 2
+MERGE_BASE_STALE = 4
+MERGE_BASE_RESULT = 8
+
+#Best common ancestors of one and two (none is an ancestor of another), newest first
+def merge_bases(repo, one, two):
+    if one == two:
+        return [one]
+
+    flags = {one: MERGE_BASE_ONE, two: MERGE_BASE_TWO}
+    #heap of (-generation, -committer date, push order, sha, parents, stale when pushed)
+    queue = list()
+    for (order, sha) in enumerate((one, two)):
+        parents, date, generation = commit_info(repo, sha)
+        heapq.heappush(queue, (-generation, -date, order, sha, parents, False))
+    order = 2
+    #queued commits that were not stale when pushed
+    active = 2
+    candidates = list()
+
+    while active > 0:
+        #dates are negated in the heap
+        _, date, _, sha, parents, stale = heapq.heappop(queue)
+        if not stale:
+            active -= 1
+
+        flag = flags[sha] & (MERGE_BASE_ONE | MERGE_BASE_TWO | MERGE_BASE_STALE)
+        if flag == MERGE_BASE_ONE | MERGE_BASE_TWO:
+            if not flags[sha] & MERGE_BASE_RESULT:
+                flags[sha] |= MERGE_BASE_RESULT
+                candidates.append((date, sha))
+            flag |= MERGE_BASE_STALE
+
+        for parent in parents:
+            if flags.get(parent, 0) & flag == flag:
+                continue
+            flags[parent] = flags.get(parent, 0) | flag
+
+            parent_parents, parent_date, generation = commit_info(repo, parent)
+            stale = bool(flag & MERGE_BASE_STALE)
+            heapq.heappush(queue, (-generation, -parent_date, order, parent, parent_parents, stale))
+            order += 1
+            if not stale:
+                active += 1
+
+    #a common ancestor painted stale is below another one
+    candidates = [sha for (_, sha) in sorted(candidates) if not flags[sha] & MERGE_BASE_STALE]
+    if len(candidates) < 2:
+        return candidates
+
+    return [sha for sha in candidates
+            if not any(other != sha and commit_is_ancestor(repo, sha, other) for other in candidates)]
+
+#True if ancestor is reachable from sha. A commit only reaches commits of a
+#lower generation: commits whose generation is not above the ancestor's are not walked.
+def commit_is_ancestor(repo, ancestor, sha):
+    _, _, floor = commit_info(repo, ancestor)
+
+    seen = {sha}
+    stack = [sha]
+    while stack:
+        sha = stack.pop()
+        if sha == ancestor:
+            return True
+
+        parents, _, generation = commit_info(repo, sha)
+        #unknown (infinite) generations prove nothing
+        if generation < floor or generation == floor != GENERATION_INFINITY:
+            continue
+
+        for parent in parents:
+            if parent not in seen:
+                seen.add(parent)
+                stack.append(parent)
+
+    return False
+
+def log_graphviz(repo, walk, max_count=None):
+    print("digraph rgitlog{")
+    print("  node[shape=rect]")
+
+    for sha in revwalk(walk, max_count):
+        commit = object_read(repo, sha, cache=False)
+        message = commit.keyvaluelist[None].decode("utf8").strip()
+        message = message.replace("\\", "\\\\")
+        message = message.replace("\"", "\\\"")
+
+        # Print first line only
+        if "\n" in message:
+            message = message[:message.index("\n")]
+
+        print(" c_{0} [label=\"{1}: {2}\"]".format(sha, sha[0:7], message))
 
-    for parent in parents:
-        parent = parent.decode("ascii")
-        print(" c_{0} -> c_{1};".format(sha, parent))
-        log_graphviz(repo, parent, seen)
+        parents = commit.keyvaluelist.get(b'parent', [])
+        if type(parents) != list:
+            parents = [ parents ]
+        if walk.first_parent:
+            parents = parents[:1]
+
+        for parent in parents:
+            print(" c_{0} -> c_{1};".format(sha, parent.decode("ascii")))
+
+    print("}")
+
+#"name <email> timestamp timezone" of an author or committer, dated as git log does
+def log_signature(value):
+    name, timestamp, tz = value.decode("utf8").rsplit(" ", 2)
+    offset = (int(tz[1:3]) * 60 + int(tz[3:5])) * (-1 if tz[0] == "-" else 1)
+    date = datetime.fromtimestamp(int(timestamp), timezone(timedelta(minutes=offset)))
+    return name, date.strftime("%a %b %-d %H:%M:%S %Y ") + tz
+
+def log_text(repo, walk, max_count=None):
+    for (i, sha) in enumerate(revwalk(walk, max_count)):
+        commit = object_read(repo, sha, cache=False)
+        author, date = log_signature(commit.keyvaluelist[b'author'])
+        message = commit.keyvaluelist[None].decode("utf8").strip("\n")
+
+        #commits are separated by a blank line
+        if i > 0:
+            print()
+        print("commit {}".format(sha))
+        parents = commit.keyvaluelist.get(b'parent')
+        if type(parents) == list:
+            print("Merge: {}".format(" ".join(parent[0:7].decode("ascii") for parent in parents)))
+        print("Author: {}".format(author))
+        print("Date:   {}".format(date))
+        print()
+        for line in message.split("\n"):
+            print("    " + line)
 
 def tree_parse_one(raw, start=0):
 
@@ -478,14 +2110,13 @@ def tree_parse_one(raw, start=0):
 
     mode = raw[start:x]
     if len(mode) == 5:
-        #Normalized to 6 bytes
-        mode = b" " + mode
+        #Normalized to 6 bytes, as git prints it (tree_serialize drops the 0 again)
+        mode = b"0" + mode
 
     y = raw.find(b'\x00', x) #null-terminator location
     path = raw[x+1:y]
 
-    sha = format(int.from_bytes(raw[y+1:y+21], "big"), "040x")
-    return y+21, GitTreeLeaf(mode, path.decode("utf8"), sha)
+    return y+21, GitTreeLeaf(mode, path.decode("utf8"), raw_sha=raw[y+1:y+21])
 
 def tree_parse(raw):
     pos = 0
@@ -497,65 +2128,163 @@ def tree_parse(raw):
     
     return result
 
+#Leaves of the tree, decoded one at a time from its serialized form
+def tree_iter(tree):
+    if tree.raw is None:
+        yield from tree.items
+        return
+
+    pos = 0
+    while pos < len(tree.raw):
+        pos, leaf = tree_parse_one(tree.raw, pos)
+        yield leaf
+
+#Start of every leaf in a serialized tree, found without decoding them
+def tree_offsets(raw):
+    offsets = list()
+    pos = 0
+    while pos < len(raw):
+        offsets.append(pos)
+        pos = raw.find(b'\x00', pos) + 21
+    return offsets
+
+#Sort key of the leaf at pos in a serialized tree, in git order: directories
+#compare as if their name ended with /
+def tree_raw_sort_key(raw, pos):
+    x = raw.find(b' ', pos)
+    y = raw.find(b'\x00', x)
+    if raw[pos:x].lstrip(b"0").startswith(b"4"):
+        return raw[x+1:y] + b"/"
+    return raw[x+1:y]
+
+def tree_raw_in_git_order(raw, offsets):
+    keys = [tree_raw_sort_key(raw, pos) for pos in offsets]
+    return all(a < b for (a, b) in zip(keys, keys[1:]))
+
+#Returns the leaf named name (no /) or None. Trees read from the store are
+#binary searched, only the leaf found is decoded, unless they are not in git order.
+def tree_lookup(tree, name):
+    if tree.raw is None:
+        for leaf in tree.items:
+            if leaf.path == name:
+                return leaf
+        return None
+
+    if tree.offsets is None:
+        tree.offsets = tree_offsets(tree.raw)
+    if tree.git_order is None:
+        tree.git_order = tree_raw_in_git_order(tree.raw, tree.offsets)
+    if not tree.git_order:
+        for leaf in tree_iter(tree):
+            if leaf.path == name:
+                return leaf
+        return None
+
+    name = name.encode("utf8")
+    key = lambda pos: tree_raw_sort_key(tree.raw, pos)
+    #a file or a directory of that name
+    for target in (name, name + b"/"):
+        i = bisect.bisect_left(tree.offsets, target, key=key)
+        if i < len(tree.offsets) and key(tree.offsets[i]) == target:
+            return tree_parse_one(tree.raw, tree.offsets[i])[1]
+    return None
+
+#Returns the leaf at path (relative to the tree tree_sha) or None, reading
+#only the trees along the path
+def tree_lookup_path(repo, tree_sha, path):
+    leaf = None
+    for name in path.split("/"):
+        if leaf is not None:
+            if not leaf.mode.lstrip(b" 0").startswith(b"4"):
+                return None
+            tree_sha = leaf.sha
+        leaf = object_read(repo, tree_sha).lookup(name)
+        if leaf is None:
+            return None
+    return leaf
+
 ### Normal git tree sorting behaviour:
 # thing (file) => thing.c => thing (directory) (as thing/)
 # as can be seen in git source in tree.c
 
 def tree_leaf_sort_key(leaf):
-    if leaf.mode.startswith(b"10"):
-        return leaf.path
-    else:
+    #only directories: symlinks (12) and submodules (16) sort as files
+    if leaf.mode.lstrip(b" 0").startswith(b"4"):
         return leaf.path + "/"
+    else:
+        return leaf.path
 
 def tree_serialize(obj):
-    obj.items.sort(key=tree_leaf_sort_key)
-    result = b''
+    if not obj.presorted:
+        obj.items.sort(key=tree_leaf_sort_key)
+
+    result = bytearray()
     for item in obj.items:
-        result +=item.mode
-        result +=b' '
+        #git writes directory modes without padding (40000), fsck rejects 040000
+        result += item.mode.lstrip(b"0")
+        result += b' '
         result += item.path.encode("utf8")
         result += b'\x00'
-        sha = int(item.sha, 16)
-        result+= sha.to_bytes(20, byteorder="big")
-    return result
+        result += item.raw_sha
+    return bytes(result)
 
-def ls_tree(repo, ref, recursive=None, prefix=""):
+#With paths, only the leaves at those paths are shown (the content of
+#directories given with a trailing / or with recursive)
+def ls_tree(repo, ref, recursive=None, prefix="", paths=None):
     sha = object_find(repo, ref, format=b"tree")
-    obj = object_read(repo, sha)
-    for item in obj.items:
-        if len(item.mode) == 5:
-            type = item.mode[0:1]
-        else:
-            type = item.mode[0:2]
-        
-        match type:
-            case b'04': type = "tree"
-            case b'10': type = "blob" #normal file
-            case b'12': type = "blob" #a symlink. blob content is link target
-            case b'16': type = "commit" # a submodule
-            case _: raise Exception("Weird tree leaf mode {}".format(item.mode))
-
-        # Leaf
-        if not (recursive and type=='tree'): 
-            print("{0} {1} {2}\t{3}".format(
-                "0" * (6 - len(item.mode)) + item.mode.decode("ascii"),
-                type, item.sha, os.path.join(prefix, item.path)))
-
-        #branch
-        else:
-            ls_tree(repo, item.sha, recursive, os.path.join(prefix, item.path))
+
+    if paths:
+        for path in paths:
+            leaf = tree_lookup_path(repo, sha, path.strip("/"))
+            if leaf is None:
+                continue
+            if leaf.mode.lstrip(b" 0").startswith(b"4") and (recursive or path.endswith("/")):
+                ls_tree(repo, leaf.sha, recursive, path.strip("/"))
+            else:
+                ls_tree_leaf(repo, leaf, recursive, os.path.dirname(path.strip("/")))
+        return
+
+    for item in tree_iter(object_read(repo, sha)):
+        ls_tree_leaf(repo, item, recursive, prefix)
+
+def ls_tree_leaf(repo, item, recursive, prefix):
+    if len(item.mode) == 5:
+        type = item.mode[0:1]
+    else:
+        type = item.mode[0:2]
+
+    match type:
+        case b'04': type = "tree"
+        case b'10': type = "blob" #normal file
+        case b'12': type = "blob" #a symlink. blob content is link target
+        case b'16': type = "commit" # a submodule
+        case _: raise Exception("Weird tree leaf mode {}".format(item.mode))
+
+    # Leaf
+    if not (recursive and type=='tree'): 
+        print("{0} {1} {2}\t{3}".format(
+            "0" * (6 - len(item.mode)) + item.mode.decode("ascii"),
+            type, item.sha, os.path.join(prefix, item.path)))
+
+    #branch
+    else:
+        ls_tree(repo, item.sha, recursive, os.path.join(prefix, item.path))
 
 def tree_checkout(repo, tree, path):
-    for item in tree.items:
-        obj = object_read(repo, item.sha)
+    for item in tree_iter(tree):
         dest = os.path.join(path, item.path)
 
-        if obj.format == b"tree":
+        if item.mode.lstrip(b" 0").startswith(b"4"):
             os.mkdir(dest)
-            tree_checkout(repo, obj, dest)
-        elif obj.format == b"blob":
+            tree_checkout(repo, object_read(repo, item.sha), dest)
+            continue
+
+        #blobs are streamed to disk, never held whole in memory
+        format, _, body = object_read_stream(repo, item.sha)
+        if format == b"blob":
             with open(dest, 'wb') as file:
-                file.write(obj.blobdata)
+                for chunk in body:
+                    file.write(chunk)
 
 def ref_resolve(repo, ref):
     path = repo_file(repo, ref)
@@ -618,6 +2347,13 @@ def ref_create(repo, ref_name, sha):
     with open(repo_file(repo, "refs/" + ref_name), 'w') as filepath:
         filepath.write(sha + "\n")
 
+""" INDEX ENTRY
+ ctime (s, ns), mtime (s, ns), dev, ino, mode (16 unused bits + 16 bits), uid, gid, size
+ as 32 bit big-endian integers, then the 20 bytes sha and the 16 bits flags (62 bytes),
+ followed by the null-terminated name and padded with null bytes to a multiple of 8
+ """
+INDEX_ENTRY = struct.Struct(">10I20sH")
+
 def index_read(repo):
     index_file = repo_file(repo, "index")
 
@@ -627,49 +2363,28 @@ def index_read(repo):
 
     with open(index_file, 'rb') as f:
         raw = f.read()
+        index_mtime = os.fstat(f.fileno()).st_mtime_ns
 
-    header = raw[:12]
-    signature = header[:4]
+    signature, version, count = struct.unpack_from(">4sII", raw, 0)
     assert signature == b"DIRC" # == DirCache
-    version = int.from_bytes(header[4:8], "big")
     assert version == 2 ### ONLY VERSION 2 IS IMPLEMENTED
-    count = int.from_bytes(header[8:12], "big")
 
     entries = list()
+    unpack_entry = INDEX_ENTRY.unpack_from
+    find = raw.find
 
-    content = raw[12:]
-    idx = 0
+    #entries are unpacked in place, without copying the rest of the file
+    idx = 12
     for i in range(0, count):
-        ctime_s = int.from_bytes(content[idx: idx+4], "big")
-        ctime_ns = int.from_bytes(content[idx+4: idx+8], "big")
+        (ctime_s, ctime_ns, mtime_s, mtime_ns, dev, ino, mode,
+         uid, gid, fsize, sha, flags) = unpack_entry(raw, idx)
 
-        mtime_s = int.from_bytes(content[idx+8: idx+12], "big")
-        mtime_ns = int.from_bytes(content[idx+12: idx+16], "big")
-
-        dev = int.from_bytes(content[idx+16: idx+20], "big")
-
-        ino = int.from_bytes(content[idx+20: idx+24], "big")
-
-        #ignore padding
-        unused = int.from_bytes(content[idx+24: idx+26], "big")
-        assert 0 == unused
-
-        mode = int.from_bytes(content[idx+26: idx+28], "big")
+        #the upper 16 bits of mode are unused padding
+        assert mode >> 16 == 0
         mode_type = mode >> 12
         assert mode_type in [0b1000, 0b1010, 0b1110]
         mode_perms = mode & 0b0000000111111111
 
-        uid = int.from_bytes(content[idx+28: idx+32], "big")
-        gid = int.from_bytes(content[idx+32: idx+36], "big")
-
-        fsize = int.from_bytes(content[idx+36: idx+40], "big")
-
-        #sha stored in lowercase hex string
-        sha = format(int.from_bytes(content[idx+40: idx+60], "big"), "040x")
-
-        #flags to be ignored
-        flags = int.from_bytes(content[idx+60: idx+62], "big")
-
         #parsing flags
         flag_assume_valid = (flags & 0b1000000000000000) !=0
         flag_extended = (flags & 0b0100000000000000) != 0
@@ -678,29 +2393,23 @@ def index_read(repo):
 
         flag_stage = flags & 0b0011000000000000
 
-        #length of name stored in 12 bits, max value is 0xFFFm 4095. Names can be larger
-        #so  git treats 0xFFF meaning at least 0xFFF and lookks for the final 0x00 to find the end the name
+        #length of name stored in 12 bits, max value is 0xFFF. Names can be larger
+        #so git treats 0xFFF meaning at least 0xFFF and looks for the final 0x00 to find the end the name
         name_length = flags & 0b0000111111111111
 
         idx += 62 # 62 bytes have been read
 
         if name_length < 0xFFF:
-            assert content[idx+ name_length] == 0x00
-            raw_name = content[idx:idx+name_length]
-            idx += name_length + 1
+            assert raw[idx + name_length] == 0x00
+            end = idx + name_length
         else:
-            print("Notice: Name is 0x{:X} bytes long.".format(name_length))
+            end = find(b'\x00', idx + 0xFFF)
 
-            # There may be errors when size is larger than 0xFFF
-            null_idx = content.find('b\x00', idx + 0xFFF)
-            raw_name = content[idx: null_idx]
-            idx = null_idx + 1
+        name = raw[idx:end].decode("utf8")
 
-        name = raw_name.decode("utf8")
-
-        #data is padded by 8*N bytes for pointer alignment;
+        #data is padded by 8*N bytes for pointer alignment (relative to the entries start);
         #skip the pad
-        idx = 8*ceil(idx/8)
+        idx = 12 + ((end - 12 + 8) & ~7)
 
         #adding to entry list
         entries.append(GitIndexEntry(ctime=(ctime_s, ctime_ns),
@@ -712,12 +2421,163 @@ def index_read(repo):
                                     uid=uid,
                                     gid=gid,
                                     fsize=fsize,
-                                    sha=sha,
+                                    sha=sha.hex(),
                                     flag_assume_valid = flag_assume_valid,
                                     flag_stage=flag_stage,
                                     name=name))
 
-    return GitIndex(version = version, entries = entries)
+    #Extensions and the trailing sha-1 of the content (absent from indexes written by older rgit)
+    extensions = dict()
+    if idx < len(raw):
+        if hashlib.sha1(memoryview(raw)[:-20]).digest() != raw[-20:]:
+            raise Exception("Index file corrupt: bad checksum")
+
+        while idx < len(raw) - 20:
+            signature, size = struct.unpack_from(">4sI", raw, idx)
+            extensions[signature] = raw[idx+8:idx+8+size]
+            idx += 8 + size
+
+    index = GitIndex(version = version, entries = entries)
+    index.mtime = ((index_mtime // 10**9) & 0xFFFFFFFF, index_mtime % 10**9)
+    index.checksum = (len(raw), raw[-20:])
+
+    for (signature, data) in extensions.items():
+        match signature:
+            case b"TREE": index.cache_tree = cache_tree_parse(data)
+            case b"RGUC": index.untracked_cache = untracked_cache_parse(data)
+            case b"RGFM": index.fsmonitor_token, index.fsmonitor_invalid = fsmonitor_extension_parse(data)
+            case _:
+                #extensions starting with an uppercase letter are optional, the others must be understood.
+                #Optional extensions rgit does not maintain are dropped on write (they would be stale).
+                if not (ord("A") <= signature[0] <= ord("Z")):
+                    raise Exception("Unsupported index extension {}".format(signature))
+
+    return index
+
+""" TREE INDEX EXTENSION (cache-tree), same format as git
+ for every directory, parents before their subdirectories (the root has an empty path):
+ [name] 0x00 [entry count] 0x20 [subtree count] 0x0a then the tree sha-1 (20 bytes) if entry count >= 0
+ counts in ascii decimal, an entry count of -1 marks a tree to rebuild
+ """
+
+def cache_tree_parse(data):
+    result = dict()
+    #[path, subtrees left to read] of the directories being read
+    stack = list()
+    pos = 0
+
+    while pos < len(data):
+        end = data.index(b'\x00', pos)
+        name = data[pos:end].decode("utf8")
+        line_end = data.index(b'\n', end)
+        count, subtrees = (int(n) for n in data[end+1:line_end].split(b' '))
+        pos = line_end + 1
+
+        sha = None
+        if count >= 0:
+            sha = data[pos:pos+20].hex()
+            pos += 20
+
+        while stack and stack[-1][1] == 0:
+            stack.pop()
+        if stack:
+            stack[-1][1] -= 1
+            path = stack[-1][0] + "/" + name if stack[-1][0] else name
+        else:
+            path = name
+
+        result[path] = (count, sha)
+        stack.append([path, subtrees])
+
+    return result
+
+def cache_tree_serialize(cache_tree):
+    subtrees = collections.defaultdict(list)
+    for path in cache_tree:
+        if path:
+            end = path.rfind("/")
+            subtrees[path[:end] if end >= 0 else ""].append(path)
+
+    result = list()
+    stack = [""] if "" in cache_tree else []
+    while stack:
+        path = stack.pop()
+        count, sha = cache_tree[path]
+        children = sorted(subtrees[path])
+        result.append("{}\x00{} {}\n".format(path[path.rfind("/")+1:], count, len(children)).encode("utf8"))
+        if count >= 0:
+            result.append(bytes.fromhex(sha))
+        stack.extend(reversed(children))
+
+    return b''.join(result)
+
+#Marks the directories containing path as changed. Invalid directories only
+#have invalid parents, the walk up stops at the first one.
+def cache_tree_invalidate(index, path):
+    if not index.cache_tree:
+        return
+
+    end = len(path)
+    while end >= 0:
+        end = path.rfind("/", 0, end)
+        dir_path = path[:end] if end >= 0 else ""
+        cached = index.cache_tree.get(dir_path)
+        if cached is not None:
+            if cached[0] < 0:
+                break
+            index.cache_tree[dir_path] = (-1, None)
+
+""" RGUC INDEX EXTENSION (untracked cache)
+ [ignore rules sha-1] then for every directory:
+ [path] 0x00 [mtime seconds] [mtime nanoseconds] [file count] [subdirectory count]
+ followed by the file names and subdirectory names, each null-terminated
+ """
+
+def untracked_cache_parse(data):
+    key = data[0:20]
+    dirs = dict()
+    pos = 20
+
+    while pos < len(data):
+        end = data.index(b'\x00', pos)
+        path = data[pos:end].decode("utf8")
+        mtime_s, mtime_ns, file_count, dir_count = struct.unpack_from(">4I", data, end+1)
+        pos = end + 17
+
+        names = list()
+        for i in range(file_count + dir_count):
+            end = data.index(b'\x00', pos)
+            names.append(data[pos:end].decode("utf8"))
+            pos = end + 1
+
+        dirs[path] = ((mtime_s, mtime_ns), names[:file_count], names[file_count:])
+
+    return GitUntrackedCache(key, dirs)
+
+def untracked_cache_serialize(cache):
+    result = [cache.key]
+
+    for (path, ((mtime_s, mtime_ns), files, dirs)) in cache.dirs.items():
+        result.append(path.encode("utf8") + b'\x00')
+        result.append(struct.pack(">4I", mtime_s, mtime_ns, len(files), len(dirs)))
+        for name in files + dirs:
+            result.append(name.encode("utf8") + b'\x00')
+
+    return b''.join(result)
+
+""" RGFM INDEX EXTENSION (fsmonitor)
+ [token] 0x00 then the names of the entries to check even if unchanged, each null-terminated
+ """
+
+def fsmonitor_extension_parse(data):
+    names = data.split(b'\x00')
+    return names[0].decode("ascii"), set(name.decode("utf8") for name in names[1:-1])
+
+def fsmonitor_extension_serialize(token, invalid):
+    return b''.join([token.encode("ascii") + b'\x00'] + [name.encode("utf8") + b'\x00' for name in sorted(invalid)])
+
+def index_extension(signature, data):
+    return signature + struct.pack(">I", len(data)) + data
 
 def gitignore_parse1(raw):
     raw = raw.strip() #removing leading / trailing spaces
@@ -734,81 +2594,425 @@ def gitignore_parse1(raw):
 def gitignore_parse(lines):
     result = list()
 
-    for line in lines:
+    for (number, line) in enumerate(lines, 1):
         parsed = gitignore_parse1(line)
         if parsed:
-            result.append(parsed)
+            result.append(parsed + (number, line.strip()))
 
     return result
 
-def gitignore_read(repo):
-    result = GitIgnore(absolute=list(), scoped=dict())
-
-    #Reading local config in .git/info/exclude
-    repo_file = os.path.join(repo.gitdir, "info/exclude")
-    if os.path.exists(repo_file):
-        with open(repo_file, "r") as file:
-            result.absolute.append(gitignore_parse(file.readlines()))
-
-    #Global config
+#.git/info/exclude and the global ignore file
+def gitignore_exclude_files(repo):
     if "XDG_CONFIG_HOME" in os.environ:
         config_home = os.environ["XDG_CONFIG_HOME"]
     else:
         config_home = os.path.expanduser("~/.config")
-    global_file = os.path.join(config_home, "git/ignore")
 
-    if os.path.exists(global_file):
-        with open(ghlobal_file, "r") as file:
-            result.absolute.append(gitignore_parse(file.readlines()))
+    return [os.path.join(repo.gitdir, "info/exclude"), os.path.join(config_home, "git/ignore")]
 
-    #.gitignore files in the index
-    index = index_read(repo)
+#Parsed rules are cached in .git as json (the blobs of the .gitignore files are
+#not read again), the cache is used while the key of the rules (see gitignore_key)
+#is unchanged. Only the rules are stored: the matchers compile them on first match.
+GITIGNORE_CACHE = "ignore-cache"
+
+#index is read if not given
+def gitignore_read(repo, index=None):
+    if index is None:
+        index = index_read(repo)
+    key = gitignore_key(repo, index)
+
+    cache_path = os.path.join(repo.gitdir, GITIGNORE_CACHE)
+    try:
+        with open(cache_path, "rb") as file:
+            if file.read(len(key)) == key:
+                cached = json.load(file)
+                absolute = [gitignore_compile(source, [tuple(rule) for rule in rules])
+                            for (source, rules) in cached["absolute"]]
+                scoped = {dir_name: gitignore_compile(source, [tuple(rule) for rule in rules])
+                          for (dir_name, (source, rules)) in cached["scoped"].items()}
+                return GitIgnore(absolute=absolute, scoped=scoped, key=key)
+    except Exception:
+        #missing or unreadable: rebuilt below
+        pass
+
+    result = GitIgnore(absolute=list(), scoped=dict(), key=key)
 
+    #Reading local config in .git/info/exclude, then global config
+    for exclude_file in gitignore_exclude_files(repo):
+        if os.path.exists(exclude_file):
+            with open(exclude_file, "r") as file:
+                source = os.path.relpath(exclude_file, repo.worktree) if exclude_file.startswith(repo.gitdir) else exclude_file
+                result.absolute.append(gitignore_compile(source, gitignore_parse(file.readlines())))
+
+    #.gitignore files in the index
     for entry in index.entries:
         if entry.name == ".gitignore" or entry.name.endswith("/.gitignore"):
             dir_name = os.path.dirname(entry.name)
             contents = object_read(repo, entry.sha)
             lines = contents.blobdata.decode("utf8").splitlines()
-            result.scoped[dir_name] = gitignore_parse(lines)
+            result.scoped[dir_name] = gitignore_compile(entry.name, gitignore_parse(lines))
+
+    #the cache is an optimization: failing to write it is not an error
+    tmp_path = None
+    try:
+        fd, tmp_path = tempfile.mkstemp(prefix="tmp_ignore_", dir=repo.gitdir)
+        with os.fdopen(fd, "wb") as file:
+            file.write(key)
+            file.write(json.dumps({
+                "absolute": [(matcher.source, matcher.rules) for matcher in result.absolute],
+                "scoped": {dir_name: (matcher.source, matcher.rules) for (dir_name, matcher) in result.scoped.items()},
+            }).encode("utf8"))
+        os.replace(tmp_path, cache_path)
+    except Exception:
+        if tmp_path and os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+
     return result
-    
-def check_ignore1(rules, path):
-    result = None
-    for (pattern, value) in rules:
-        if fnmatch(path, pattern):
-            result = value
+
+#Identifies the ignore rules in effect: the .gitignore blobs in the index and
+#the stat data of the exclude files. Results computed with the rules stay valid
+#while the key is unchanged.
+def gitignore_key(repo, index):
+    key = hashlib.sha1(GITIGNORE_SEMANTICS)
+
+    for entry in index.entries:
+        if entry.name == ".gitignore" or entry.name.endswith("/.gitignore"):
+            key.update("{} {}\n".format(entry.name, entry.sha).encode("utf8"))
+
+    for exclude_file in gitignore_exclude_files(repo):
+        if os.path.exists(exclude_file):
+            file_stat = os.stat(exclude_file)
+            key.update("{} {} {}\n".format(exclude_file, file_stat.st_mtime_ns, file_stat.st_size).encode("utf8"))
+
+    return key.digest()
+
+#Bumped whenever matching or GitIgnoreMatcher changes, so that results cached
+#with the old rules (the untracked cache, the ignore cache) are not reused
+GITIGNORE_SEMANTICS = b"wildmatch 2\n"
+
+gitignoreGlobRE = re.compile(r"[*?[\\]")
+
+#Splits a parsed pattern into (pattern, anchored, dir_only), as git does:
+#a trailing / only matches directories, and a pattern containing a / anywhere
+#else is matched against the whole path relative to the .gitignore directory
+#instead of against the basename at any depth
+def gitignore_pattern_split(pattern):
+    dir_only = pattern.endswith("/")
+    if dir_only:
+        pattern = pattern.rstrip("/")
+    anchored = "/" in pattern
+    if pattern.startswith("/"):
+        pattern = pattern[1:]
+    return (pattern, anchored, dir_only)
+
+#Translates a gitignore glob into a regex (without groups): * and ? never
+#match /, a leading **/ matches any number of directories, a trailing /**
+#everything inside, and /**/ zero or more directories
+def gitignore_translate(pattern):
+    result = list()
+    i = 0
+    n = len(pattern)
+    while i < n:
+        c = pattern[i]
+        i += 1
+        match c:
+            case "*":
+                if i < n and pattern[i] == "*":
+                    i += 1
+                    whole = i - 2 == 0 or pattern[i - 3] == "/"
+                    if whole and i == n:
+                        result.append(".*")
+                        continue
+                    if whole and pattern[i] == "/":
+                        result.append("(?:.*/)?")
+                        i += 1
+                        continue
+                result.append("[^/]*")
+            case "?":
+                result.append("[^/]")
+            case "[":
+                j = i
+                if j < n and pattern[j] in "!^":
+                    j += 1
+                if j < n and pattern[j] == "]":
+                    j += 1
+                j = pattern.find("]", j)
+                if j < 0:
+                    #no closing bracket: a literal [
+                    result.append(re.escape(c))
+                    continue
+                members = pattern[i:j]
+                i = j + 1
+                negate = members[:1] in ("!", "^")
+                if negate:
+                    members = members[1:]
+                members = "".join(m if m == "-" else re.escape(m) for m in members)
+                result.append("[^/{}]".format(members) if negate else "(?!/)[{}]".format(members))
+            case "\\":
+                if i < n:
+                    result.append(re.escape(pattern[i]))
+                    i += 1
+            case _:
+                result.append(re.escape(c))
+    return "".join(result)
+
+#Builds the lookup tables for one kind of path (see GitIgnoreMatcher).
+#rules is a list of (index, pattern, anchored); regex alternatives are ordered
+#last rule first, so the group that matches is the last matching rule.
+def gitignore_compile1(rules):
+    basenames = dict()
+    extensions = dict()
+    basename_globs = list()
+    path_globs = list()
+    for (index, pattern, anchored) in rules:
+        if anchored:
+            path_globs.append((index, pattern))
+        elif not gitignoreGlobRE.search(pattern):
+            basenames[pattern] = index
+        elif pattern.startswith("*.") and not gitignoreGlobRE.search(pattern[1:]):
+            extensions[pattern[1:]] = index
+        else:
+            basename_globs.append((index, pattern))
+    regexes = list()
+    for globs in (basename_globs, path_globs):
+        if globs:
+            regex = "|".join("(?P<r{}>{})".format(index, gitignore_translate(pattern))
+                             for (index, pattern) in reversed(globs))
+            regexes.append(re.compile(regex, re.DOTALL))
+        else:
+            regexes.append(None)
+    return (basenames, extensions, regexes[0], regexes[1])
+
+#The regexes are only built when the matcher is first used (see GitIgnoreMatcher)
+def gitignore_compile(source, rules):
+    return GitIgnoreMatcher(source, rules)
+
+def gitignore_compile_rules(rules):
+    files = list()
+    dirs = list()
+    for (index, (pattern, value, number, line)) in enumerate(rules):
+        (pattern, anchored, dir_only) = gitignore_pattern_split(pattern)
+        if not pattern:
+            continue
+        if not dir_only:
+            files.append((index, pattern, anchored))
+        dirs.append((index, pattern, anchored))
+    return (gitignore_compile1(files), gitignore_compile1(dirs))
+
+#Returns the index of the last rule of matcher matching path (relative to the
+#directory of the rules), or -1
+def gitignore_match(matcher, path, is_dir=False):
+    (basenames, extensions, basename_regex, path_regex) = matcher.dirs if is_dir else matcher.files
+    basename = path[path.rfind("/") + 1:]
+    result = basenames.get(basename, -1)
+    if extensions:
+        dot = basename.find(".")
+        while dot >= 0:
+            result = max(result, extensions.get(basename[dot:], -1))
+            dot = basename.find(".", dot + 1)
+    if basename_regex:
+        match = basename_regex.fullmatch(basename)
+        if match:
+            result = max(result, int(match.lastgroup[1:]))
+    if path_regex:
+        match = path_regex.fullmatch(path)
+        if match:
+            result = max(result, int(match.lastgroup[1:]))
     return result
 
-def check_ignore_scoped(rules, path):
-    parent = os.path.dirname(path)
+#The check_ignore functions below return the deciding match as a pair
+#(GitIgnoreMatcher, rule index), None if no rule matches
+def check_ignore1(rules, path, is_dir=False):
+    index = gitignore_match(rules, path, is_dir)
+    if index < 0:
+        return None
+    return (rules, index)
+
+def check_ignore_scoped(rules, path, is_dir=False):
+    if not rules:
+        return None
+    end = path.rfind("/")
     while True:
-        if parent in rules:
-            result = check_ignore1(rules[parent], path)
+        ruleset = rules.get(path[:end] if end >= 0 else "")
+        if ruleset is not None:
+            result = check_ignore1(ruleset, path[end + 1:], is_dir)
             if result != None:
                 return result
-        if parent == "":
+        if end < 0:
             break
-        parent = os.path.dirname(parent)
+        end = path.rfind("/", 0, end)
     return None
 
-def check_ignore_absolute(rules, path):
-    parent = os.path.dirname(path)
+def check_ignore_absolute(rules, path, is_dir=False):
     for ruleset in rules:
-        result = check_ignore1(ruleset, path)
+        result = check_ignore1(ruleset, path, is_dir)
         if result != None:
             return result
-    return False
+    return None
+
+def check_ignore_path(rules, path, is_dir=False):
+    result = check_ignore_scoped(rules.scoped, path, is_dir)
+    if result != None:
+        return result
+    return check_ignore_absolute(rules.absolute, path, is_dir)
 
-def check_ignore(rules, path):
+#A path is ignored if one of its parent directories is, whatever the rules say
+#about the path itself. Callers that already checked the parents (the worktree
+#walk, which never enters ignored directories) pass parents=False.
+def check_ignore_match(rules, path, is_dir=False, parents=True):
     if os.path.isabs(path):
         raise Exception("This function requires path to be relative to the repository's root")
+    if parents:
+        end = path.find("/")
+        while end >= 0:
+            result = check_ignore_path(rules, path[:end], True)
+            if result != None and result[0].rules[result[1]][1]:
+                return result
+            end = path.find("/", end + 1)
+    return check_ignore_path(rules, path, is_dir)
+
+def check_ignore(rules, path, is_dir=False, parents=True):
+    result = check_ignore_match(rules, path, is_dir, parents)
+    return result != None and result[0].rules[result[1]][1]
+
+#Yields the files of the worktree under start (relative to the worktree), skipping
+#ignored files and never descending into .git or ignored directories.
+#Every directory is read once with os.scandir, which also gives the file types.
+#With an untracked cache, directories whose mtime did not change are not read.
+def worktree_walk(repo, rules, start="", cache=None, index=None, dirty_dirs=None):
+    stack = [start]
+
+    while stack:
+        dir_path = stack.pop()
+        files, dirs = worktree_list_dir(repo, rules, dir_path, cache, index, dirty_dirs)
+
+        for name in files:
+            yield os.path.join(dir_path, name)
+        for name in dirs:
+            stack.append(os.path.join(dir_path, name))
+
+#Returns (files, subdirectories) of a worktree directory, ignored names left out.
+#dirty_dirs, from the fsmonitor, are the only directories that may have changed.
+def worktree_list_dir(repo, rules, dir_path, cache=None, index=None, dirty_dirs=None):
+    full_path = os.path.join(repo.worktree, dir_path)
+
+    if cache is not None and dirty_dirs is not None and dir_path not in dirty_dirs:
+        cached = cache.dirs.get(dir_path)
+        if cached:
+            cache.visited[dir_path] = cached
+            return cached[1], cached[2]
+
+    if cache is not None:
+        dir_mtime = os.stat(full_path).st_mtime_ns
+        dir_mtime = ((dir_mtime // 10**9) & 0xFFFFFFFF, dir_mtime % 10**9)
+
+        #a directory changed in the same timestamp as the index was written
+        #may have been listed before the change (racy, as for index entries)
+        cached = cache.dirs.get(dir_path)
+        if cached and cached[0] == dir_mtime and index.mtime and dir_mtime < index.mtime:
+            cache.visited[dir_path] = cached
+            return cached[1], cached[2]
+
+    files = list()
+    dirs = list()
+    with os.scandir(full_path) as entries:
+        for entry in entries:
+            if entry.name == ".git":
+                continue
+            rel_path = os.path.join(dir_path, entry.name)
+
+            if entry.is_dir(follow_symlinks=False):
+                #pruning: nothing below an ignored directory is looked at
+                if not check_ignore(rules, rel_path, True, parents=False):
+                    dirs.append(entry.name)
+            elif entry.is_file() and not check_ignore(rules, rel_path, parents=False):
+                files.append(entry.name)
+
+    if cache is not None:
+        cache.visited[dir_path] = (dir_mtime, files, dirs)
+        cache.changed = True
+
+    return files, dirs
+
+pathspecRE = re.compile(r"[*?[]")
+
+#Returns True if path is a glob pathspec rather than a plain path
+def pathspec_is_glob(path):
+    return pathspecRE.search(path) is not None and not os.path.lexists(path)
+
+#Expands files, directories and glob pathspecs (relative to the current directory)
+#into a dictionary {path relative to worktree: absolute path} of files to add.
+#Tracked files that are gone map to None: they are to be removed from the index.
+#As in git, naming an ignored file that is not tracked is an error unless forced,
+#and the tracked files under a directory or matching a glob are always included.
+def pathspec_expand(repo, paths, index=None, force=False):
+    worktree = repo.worktree + os.sep
+    result = dict()
+    rules = None
+    ignored = list()
 
-    result = check_ignore_scoped(rules.scoped, path)
+    if index is None:
+        index = index_read(repo)
+    tracked = set(entry.name for entry in index.entries)
 
-    if result != None:
-        return result
+    for path in paths:
+        abspath = os.path.abspath(path)
+        if not (abspath.startswith(worktree) or abspath == repo.worktree):
+            raise Exception("Outside the worktree: {}".format(path))
+        relpath = os.path.relpath(abspath, repo.worktree)
+
+        if rules is None and not (relpath in tracked or force):
+            rules = gitignore_read(repo, index)
+
+        if os.path.isfile(abspath):
+            if relpath in tracked or force or not check_ignore(rules, relpath):
+                result[relpath] = abspath
+            else:
+                ignored.append(relpath)
+            continue
+
+        if relpath in tracked and not os.path.lexists(abspath):
+            result[relpath] = None
+            continue
+
+        if rules is None:
+            #nothing is ignored when forced
+            rules = GitIgnore(absolute=list(), scoped=dict()) if force else gitignore_read(repo, index)
+
+        if os.path.isdir(abspath):
+            start = "" if relpath == "." else relpath
+            prefix = start + "/" if start else ""
+            tracked_matches = [name for name in tracked if name.startswith(prefix)]
+            if start and not force and not tracked_matches and check_ignore(rules, start, is_dir=True):
+                ignored.append(relpath)
+                continue
+            matches = list(worktree_walk(repo, rules, start))
+        elif pathspec_is_glob(path):
+            tracked_matches = [name for name in tracked if fnmatch(name, relpath)]
+            #walking only below the directories without wildcards
+            start = os.path.dirname(pathspecRE.split(relpath)[0])
+            if os.path.isdir(os.path.join(repo.worktree, start)):
+                matches = [f for f in worktree_walk(repo, rules, start) if fnmatch(f, relpath)]
+            else:
+                matches = list()
+        else:
+            raise Exception("Not a file, directory or pathspec: {}".format(path))
+
+        if not matches and not tracked_matches:
+            raise Exception("Pathspec {} did not match any files".format(path))
 
-    return check_ignore_absolute(rules.absolute, path)
+        #tracked files are added even if ignored, and removed if gone
+        for name in tracked_matches:
+            name_path = os.path.join(repo.worktree, name)
+            result[name] = name_path if os.path.isfile(name_path) else None
+        for match in matches:
+            result[match] = os.path.join(repo.worktree, match)
+
+    if ignored:
+        raise Exception("The following paths are ignored by one of your .gitignore files:\n{}\n"
+                        "Use -f if you really want to add them.".format("\n".join(ignored)))
+
+    return result
 
 def branch_get_active(repo):
     with open(repo_file(repo, "HEAD"), "r") as file:
@@ -824,7 +3028,7 @@ def tree_to_dict(repo, ref, prefix=""):
     tree_sha = object_find(repo, ref, format=b"tree")
     tree = object_read(repo, tree_sha)
 
-    for leaf in tree.items:
+    for leaf in tree_iter(tree):
         full_path = os.path.join(prefix, leaf.path)
 
         #reading object to get type
@@ -837,139 +3041,322 @@ def tree_to_dict(repo, ref, prefix=""):
 
     return result
 
-def index_write(repo, index):
-    with open(repo_file(repo, "index"), "wb") as file:
-
-        #HEADER
-
-        #magic bytes
-        file.write(b"DIRC")
-        #version number
-        file.write(index.version.to_bytes(4, "big"))
-        #number of entries
-        file.write(len(index.entries).to_bytes(4, "big"))
-
-        #Entries
-        idx = 0
-        for entry in index.entries:
-            file.write(entry.ctime[0].to_bytes(4, "big"))
-            file.write(entry.ctime[1].to_bytes(4, "big"))
-            file.write(entry.mtime[0].to_bytes(4, "big"))
-            file.write(entry.mtime[1].to_bytes(4, "big"))
-            file.write(entry.dev.to_bytes(4, "big"))
-            file.write(entry.ino.to_bytes(4, "big"))
-
-            #Mode
-            mode = (entry.mode_type << 12) | entry.mode_perms
-            file.write(mode.to_bytes(4, "big"))
-
-            file.write(entry.uid.to_bytes(4, "big"))
-            file.write(entry.gid.to_bytes(4, "big"))
+#The whole index is built in memory and written once, followed by the sha-1
+#of its content as git does, through index.lock renamed over the index:
+#readers never see a half-written index and a crash leaves the old one intact
+#With verify, the index is only written if the file is still the one index was
+#read from (see index_file_write), returns False if it was not written
+def index_write(repo, index, verify=False):
+    result = bytearray()
 
-            file.write(entry.fsize.to_bytes(4, "big"))
-            file.write(int(entry.sha, 16).to_bytes(20, "big"))
+    #HEADER
+    #magic bytes, version number, number of entries
+    result += struct.pack(">4sII", b"DIRC", index.version, len(index.entries))
 
-            flag_assume_valid = 0x1 << 15 if entry.flag_assume_valid else 0
-
-            name_bytes = entry.name.encode("utf8")
-            bytes_len = len(name_bytes)
-            if bytes_len >= 0xFFF:
-                name_length = 0xFFF
-            else:
-                name_length = bytes_len
-
-            # Merging the three parts into one (2 flags + length)
-            file.write((flag_assume_valid | entry.flag_stage | name_length).to_bytes(2, "big"))
-
-            file.write(name_bytes)
-            file.write((0).to_bytes(1, "big"))
-
-            idx += 62 + len(name_bytes) + 1
+    #Entries
+    pack_entry = INDEX_ENTRY.pack
+    for entry in index.entries:
+        #Mode
+        mode = (entry.mode_type << 12) | entry.mode_perms
 
-            # Adding padding if necessary
+        flag_assume_valid = 0x1 << 15 if entry.flag_assume_valid else 0
 
-            if idx % 8 != 0:
-                pad = 8 - (idx % 8)
-                file.write((0).to_bytes(pad, "big"))
-                idx += pad
+        name_bytes = entry.name.encode("utf8")
+        bytes_len = len(name_bytes)
+        if bytes_len >= 0xFFF:
+            name_length = 0xFFF
+        else:
+            name_length = bytes_len
+
+        #stat fields are stored on 32 bits, git keeps the lower bits
+        result += pack_entry(entry.ctime_s & 0xFFFFFFFF, entry.ctime_ns,
+                             entry.mtime_s & 0xFFFFFFFF, entry.mtime_ns,
+                             entry.dev & 0xFFFFFFFF, entry.ino & 0xFFFFFFFF,
+                             mode, entry.uid, entry.gid, entry.fsize & 0xFFFFFFFF,
+                             bytes.fromhex(entry.sha),
+                             # Merging the three parts into one (2 flags + length)
+                             flag_assume_valid | entry.flag_stage | name_length)
+        result += name_bytes
+
+        # null terminator and padding to a multiple of 8 (1 to 8 null bytes)
+        result += bytes(8 - (62 + bytes_len) % 8)
+
+    #Extensions
+    if index.cache_tree:
+        result += index_extension(b"TREE", cache_tree_serialize(index.cache_tree))
+    if index.untracked_cache:
+        result += index_extension(b"RGUC", untracked_cache_serialize(index.untracked_cache))
+    if index.fsmonitor_token:
+        result += index_extension(b"RGFM", fsmonitor_extension_serialize(index.fsmonitor_token, index.fsmonitor_invalid or set()))
+
+    result += hashlib.sha1(result).digest()
+
+    if not index_file_write(repo, result, index.checksum if verify else False):
+        return False
+    index.checksum = (len(result), bytes(result[-20:]))
+    return True
+
+class GitIndexLockedError(Exception):
+    '''index.lock is held by another process'''
+    pass
+
+#(size, trailing sha-1) of the index file, None if there is none
+def index_file_checksum(path):
+    try:
+        with open(path, "rb") as file:
+            size = os.fstat(file.fileno()).st_size
+            file.seek(max(size - 20, 0))
+            return (size, file.read())
+    except FileNotFoundError:
+        return None
 
-def rm(repo, paths, delete=True, skip_missing=False):
+#Replaces the index under index.lock. Unless expected is False, the index is
+#left alone (returns False) when its checksum is no longer expected: another
+#process wrote it after it was read, as git's repo_verify_index.
+def index_file_write(repo, data, expected=False):
+    path = repo_file(repo, "index")
+    lock = path + ".lock"
+
+    try:
+        fd = os.open(lock, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+    except FileExistsError:
+        raise GitIndexLockedError("Unable to create {}: another rgit process seems to be running".format(lock))
+
+    try:
+        with os.fdopen(fd, "wb") as file:
+            if expected is not False and index_file_checksum(path) != expected:
+                os.unlink(lock)
+                return False
+
+            file.write(data)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(lock, path)
+    except BaseException:
+        if os.path.exists(lock):
+            os.unlink(lock)
+        raise
+
+    return True
+
+def rm(repo, paths, delete=True, skip_missing=False, recursive=False):
     #find and read index
     index = index_read(repo)
 
     worktree = repo.worktree + os.sep
 
-    #making paths absolute
-    abspaths = list()
+    #git keeps the index sorted by name, directories are contiguous ranges of it
+    index.entries.sort(key=lambda entry: entry.name)
+    names = [entry.name for entry in index.entries]
+    positions = {name: i for (i, name) in enumerate(names)}
+
+    #positions of the index entries to remove
+    remove = set()
+    missing = list()
+
     for path in paths:
         abspath = os.path.abspath(path)
-        if abspath.startswith(worktree):
-            abspaths.append(abspath)
-        else:
+        if not (abspath.startswith(worktree) or (recursive and abspath == repo.worktree)):
             raise Exception("Cannot remove paths outside of worktree: {}".format(paths))
+        relpath = os.path.relpath(abspath, repo.worktree)
 
-    kept_entries = list()
-    remove = list()
+        if relpath in positions:
+            remove.add(positions[relpath])
+            continue
 
-    for entry in index.entries:
-        full_path = os.path.join(repo.worktree, entry.name)
+        #glob pathspecs are matched against the index
+        if pathspec_is_glob(path):
+            matches = [i for (i, name) in enumerate(names) if fnmatch(name, relpath)]
+        else:
+            #directory: the entries sorted between "dir/" and "dir0" ('0' follows '/')
+            if relpath == ".":
+                matches = range(0, len(names))
+            else:
+                matches = range(bisect.bisect_left(names, relpath + "/"),
+                                bisect.bisect_left(names, relpath + "0"))
+            if matches and not recursive:
+                raise Exception("Not removing {} recursively without -r".format(path))
 
-        if full_path in abspaths:
-            remove.append(full_path)
-            abspaths.remove(full_path)
+        if matches:
+            remove.update(matches)
         else:
-            kept_entries.append(entry) #saving entry
+            missing.append(abspath)
 
-    if len(abspaths) > 0 and not skip_missing:
-        raise Exception("Cannot remove paths not in the index: {}".format(abspaths))
+    if len(missing) > 0 and not skip_missing:
+        raise Exception("Cannot remove paths not in the index: {}".format(missing))
 
     if delete:
-        for path in remove:
-            os.unlink(path)
-
-    index.entries = kept_entries
+        parents = set()
+        for i in remove:
+            full_path = os.path.join(repo.worktree, names[i])
+            if os.path.lexists(full_path):
+                os.unlink(full_path)
+            parents.add(os.path.dirname(full_path))
+
+        #like git, directories left empty are removed too (deepest first)
+        for parent in sorted(parents, key=len, reverse=True):
+            while parent != repo.worktree:
+                try:
+                    os.rmdir(parent)
+                except OSError:
+                    break #not empty (or already removed)
+                parent = os.path.dirname(parent)
+
+    for i in remove:
+        cache_tree_invalidate(index, names[i])
+    index.entries = [entry for (i, entry) in enumerate(index.entries) if i not in remove]
     index_write(repo, index)
 
-def add(repo, paths, delete=True, skip_missing=False):
-    #remove all paths from index
-
-    rm(repo, paths, delete=False, skip_missing=True)
-
-    worktree = repo.worktree + os.sep
+def add(repo, paths, delete=True, skip_missing=False, force=False):
+    #The index is read and written once for all the paths:
+    #entries of the added paths are replaced by the new ones
+    index = index_read(repo)
 
-    #convert paths to paris: (absolute, relative_to_worktree)
-    #delte them form index if present
-    clean_paths = list()
-    for path in paths:
-        abspath = os.path.abspath(path)
-        if not (abspath.startswith(worktree) and os.path.isfile(abspath)):
-            raise Exception("Not a file, or outside the worktree: {}".format(paths))
-        relpath = os.path.relpath(abspath, repo.worktree)
-        clean_paths.append((abspath, relpath))
+    #files, directories and glob pathspecs as pairs: (relative_to_worktree: absolute),
+    #absolute is None for tracked files removed from the worktree
+    clean_paths = pathspec_expand(repo, paths, index, force)
 
-        #find an read the index; it was modified by rm
+    old_entries = {entry.name: entry for entry in index.entries if entry.name in clean_paths}
+    index.entries = [entry for entry in index.entries if entry.name not in clean_paths]
 
-        index = index_read(repo)
+    #entries still matching their file on stat (and not racy) are kept as they are,
+    #only the other files are hashed
+    changed_paths = list()
+    for (relpath, abspath) in clean_paths.items():
+        if abspath is None:
+            cache_tree_invalidate(index, relpath)
+            continue
 
-        for(abspath, relpath) in clean_paths:
-            with open(abspath, "rb") as fd:
-                sha = object_hash(fd, b"blob", repo)
+        old = old_entries.get(relpath)
+        if old is not None and not index_entry_is_racy(index, old):
+            try:
+                if index_entry_stat_matches(old, os.stat(abspath)):
+                    index.entries.append(old)
+                    continue
+            except FileNotFoundError:
+                pass
+        changed_paths.append((relpath, abspath))
+
+    #hashing runs on all cores, zlib and hashlib release the GIL
+    with concurrent.futures.ThreadPoolExecutor(max_workers=os.cpu_count()) as pool:
+        new_entries = list(pool.map(lambda item: index_entry_from_file(repo, item[1], item[0]),
+                                    changed_paths))
+    index.entries.extend(new_entries)
+
+    #only the trees of files whose content or mode changed have to be rebuilt
+    for entry in new_entries:
+        old = old_entries.get(entry.name)
+        if old is None or (old.sha, old.mode_type, old.mode_perms) != (entry.sha, entry.mode_type, entry.mode_perms):
+            cache_tree_invalidate(index, entry.name)
+
+    #git keeps the index sorted by name
+    index.entries.sort(key=lambda entry: entry.name)
+
+    #writing index back
+    index_write(repo, index)
 
-            stat = os.stat(abspath)
+#Stores the file as a blob and returns its index entry
+def index_entry_from_file(repo, abspath, relpath):
+    #stat before hashing: a change made while hashing shows up as a new mtime
+    file_stat = os.stat(abspath)
+    sha = object_hash_file(abspath, repo)
+
+    entry = GitIndexEntry(mode_type=0b1000, mode_perms=0o644, sha=sha, flag_assume_valid=False,
+                        flag_stage=False, name=relpath)
+    index_entry_stat_update(entry, file_stat)
+    return entry
+
+#Stat data as stored in the index: seconds and sizes on 32 bits
+def index_entry_stat_update(entry, file_stat):
+    entry.ctime = ((file_stat.st_ctime_ns // 10**9) & 0xFFFFFFFF, file_stat.st_ctime_ns % 10**9)
+    entry.mtime = ((file_stat.st_mtime_ns // 10**9) & 0xFFFFFFFF, file_stat.st_mtime_ns % 10**9)
+    entry.dev = file_stat.st_dev & 0xFFFFFFFF
+    entry.ino = file_stat.st_ino & 0xFFFFFFFF
+    entry.uid = file_stat.st_uid
+    entry.gid = file_stat.st_gid
+    entry.fsize = file_stat.st_size & 0xFFFFFFFF
+
+#Full stat comparison, a match means the file is unchanged since it was added
+#(unless the entry is racy, see index_entry_is_racy)
+def index_entry_stat_matches(entry, file_stat):
+    return (stat.S_ISREG(file_stat.st_mode) and
+            entry.mtime_ns == file_stat.st_mtime_ns % 10**9 and
+            entry.mtime_s == (file_stat.st_mtime_ns // 10**9) & 0xFFFFFFFF and
+            entry.ctime_ns == file_stat.st_ctime_ns % 10**9 and
+            entry.ctime_s == (file_stat.st_ctime_ns // 10**9) & 0xFFFFFFFF and
+            entry.fsize == file_stat.st_size & 0xFFFFFFFF and
+            entry.ino == file_stat.st_ino & 0xFFFFFFFF and
+            entry.dev == file_stat.st_dev & 0xFFFFFFFF and
+            entry.uid == file_stat.st_uid and
+            entry.gid == file_stat.st_gid)
+
+#Racy git: a file modified in the same timestamp as the index was written may
+#keep the stat data of the entry with a different content. Entries not older
+#than the index file can not be trusted on stat alone.
+def index_entry_is_racy(index, entry):
+    return index.mtime is not None and entry.mtime >= index.mtime
+
+#Compares the entry with the worktree: returns (state, refreshed) with state
+#None, "deleted" or "modified". Files whose content turns out to be unchanged
+#get their stat data refreshed in the entry, so the next check is a stat only.
+def index_entry_check(repo, index, entry):
+    full_path = os.path.join(repo.worktree, entry.name)
+
+    try:
+        file_stat = os.stat(full_path)
+    except FileNotFoundError:
+        return "deleted", False
+
+    if index_entry_stat_matches(entry, file_stat) and not index_entry_is_racy(index, entry):
+        return None, False
+
+    #not a regular file anymore (a directory, for example)
+    if not stat.S_ISREG(file_stat.st_mode):
+        return "modified", False
+
+    #if hashes are the same => files are the same
+    if object_hash_file(full_path) != entry.sha:
+        return "modified", False
+
+    refreshed = not index_entry_stat_matches(entry, file_stat)
+    if refreshed:
+        index_entry_stat_update(entry, file_stat)
+    return None, refreshed
+
+#Entries checked by one worker at a time, below this threads are not worth it
+PRELOAD_CHUNK = 500
+
+#index_entry_check for every entry, results in index order. The stat syscalls
+#(and rehashes) dominate on cold caches and network filesystems: chunks of
+#entries are checked concurrently, like git's core.preloadIndex.
+def index_check_worktree(repo, index, jobs=1, entries=None):
+    if entries is None:
+        entries = index.entries
+
+    def check(chunk):
+        return [index_entry_check(repo, index, entry) for entry in chunk]
+
+    if jobs <= 1 or len(entries) <= PRELOAD_CHUNK:
+        return check(entries)
+
+    size = max(PRELOAD_CHUNK, -(-len(entries) // jobs))
+    chunks = [entries[i:i+size] for i in range(0, len(entries), size)]
 
-            ctime_s = int(stat.st_ctime)
-            ctime_ns = stat.st_ctime_ns % 10**9
-            mtime_s = int(stat.st_mtime)
-            mtime_ns = stat.st_mtime_ns % 10**9
+    result = list()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+        #map keeps the order of the chunks
+        for chunk_result in pool.map(check, chunks):
+            result.extend(chunk_result)
 
-            entry = GitIndexEntry(ctime=(ctime_s, ctime_ns), mtime=(mtime_s, mtime_ns), dev=stat.st_dev, ino=stat.st_ino,
-                                mode_type=0b1000, mode_perms=0o644, uid=stat.st_uid, gid=stat.st_gid,
-                                fsize=stat.st_size, sha=sha, flag_assume_valid=False,
-                                flag_stage=False, name=relpath)
-            index.entries.append(entry)
+    return result
 
-        #writing index back
-        index_write(repo, index)
+#Number of status workers: --jobs, else one per core unless core.preloadIndex is false
+def status_jobs(repo, jobs=None):
+    if jobs:
+        return jobs
+    if repo.conf.getboolean("core", "preloadIndex", fallback=True):
+        return os.cpu_count() or 1
+    return 1
 
 def gitconfig_read():
     xdg_config_home = os.environ["XDG_CONFIG_HOME"] if "XDG_CONFIG_HOME" in os.environ else "~/.config"
@@ -988,49 +3375,87 @@ def gitconfig_user_get(config):
             return "{} <{}>".format(config["user"]["name"], config["user"]["email"])
     return "Unknown User"
 
+#Builds the trees of the index bottom-up in a single pass over the sorted entries:
+#the entries of a directory are contiguous, a directory is complete (and its tree
+#written) as soon as an entry outside of it comes. Trees still valid in the
+#cache-tree of the index are not rebuilt, their entries are skipped; the index
+#gets the cache-tree of the new trees. Returns the sha of the root tree.
 def tree_from_index(repo, index):
-    contents = dict()
-    contents[""] = list()
+    entries = index.entries
+    cache_tree = index.cache_tree if index.cache_tree is not None else dict()
 
-    #Enumerate entries, and making them dictionaries ( key = directory, content = values)
+    count, sha = cache_tree.get("", (-1, None))
+    if count == len(entries) and sha:
+        return sha
 
-    for entry in index.entries:
-        dirname = os.path.dirname(entry.name)
+    #directories being built: [path, leaves, number of index entries below it]
+    stack = [["", list(), 0]]
 
-        key = dirname
-        while key!= "":
-            if not key in contents:
-                contents[key] = list()
-            key = os.path.dirname(key)
+    i = 0
+    while i < len(entries):
+        name = entries[i].name
 
-        contents[dirname].append(entry)
+        #complete the directories that do not contain the entry
+        while stack[-1][0] and not name.startswith(stack[-1][0] + "/"):
+            tree_from_index_write(repo, cache_tree, stack)
 
-    #sort paths descending by length
-    sorted_paths = sorted(contents.keys(), key=len, reverse=True)
+        #open the directories down to the entry, or reuse a cached subtree
+        dir_end = name.rfind("/")
+        skipped = False
+        while dir_end > len(stack[-1][0]):
+            start = len(stack[-1][0]) + 1 if stack[-1][0] else 0
+            path = name[:name.find("/", start)]
 
-    #curr tree sha, after iteration it will be root tree sha
-    sha = None
+            count, sha = cache_tree.get(path, (-1, None))
+            if count > 0 and tree_from_index_covers(entries, i, count, path):
+                stack[-1][1].append(GitTreeLeaf(mode=b"040000", path=path[start:], sha=sha))
+                stack[-1][2] += count
+                i += count
+                skipped = True
+                break
 
-    for path in sorted_paths:
-        tree = GitTree()
+            stack.append([path, list(), 0])
+
+        if skipped:
+            continue
 
-        for entry in contents[path]:
-            if isinstance(entry, GitIndexEntry): #regular entry (file)
-                #transcode the mode: entry is int, ascii is needed
-                leaf_mode = "{:02o}{:04o}".format(entry.mode_type, entry.mode_perms).encode("ascii")
-                leaf = GitTreeLeaf(mode = leaf_mode, path=os.path.basename(entry.name), sha=entry.sha)
-            else: #Tree :+ sotred as a pair (basename, SHA)
-                leaf = GitTreeLeaf(mode = b"0400000", path=entry[0], sha=entry[1])
+        entry = entries[i]
+        #transcode the mode: entry is int, ascii is needed
+        leaf_mode = "{:02o}{:04o}".format(entry.mode_type, entry.mode_perms).encode("ascii")
+        stack[-1][1].append(GitTreeLeaf(mode=leaf_mode, path=name[dir_end+1:], sha=entry.sha))
+        stack[-1][2] += 1
+        i += 1
 
-            tree.items.append(leaf)
+    while len(stack) > 1:
+        tree_from_index_write(repo, cache_tree, stack)
+    sha = tree_from_index_write(repo, cache_tree, stack)
 
-        #Write the new tree object to the store
-        sha = object_write(tree, repo)
+    #directories still invalid no longer have entries
+    index.cache_tree = {path: cached for (path, cached) in cache_tree.items() if cached[0] >= 0}
+    return sha
 
-        #add new tree hash to curr dictionary's parent as pair (basename, SHA)
-        parent = os.path.dirname(path)
-        base = os.path.basename(path) # name without path: ex main.c for src/main.c
-        contents[parent].append((base, sha))
+#A cached entry count is only trusted if it spans exactly the entries below path
+def tree_from_index_covers(entries, start, count, path):
+    end = start + count
+    prefix = path + "/"
+    return (end <= len(entries) and entries[end - 1].name.startswith(prefix)
+            and (end == len(entries) or not entries[end].name.startswith(prefix)))
+
+#Writes the tree on top of the stack and adds it to its parent directory
+def tree_from_index_write(repo, cache_tree, stack):
+    path, leaves, count = stack.pop()
+
+    tree = GitTree()
+    tree.items = leaves
+    #leaves come in index order, which is tree order (a directory d holds the
+    #entries d/..., that sort as d/ does)
+    tree.presorted = True
+    sha = object_write(tree, repo)
+    cache_tree[path] = (count, sha)
+
+    if stack:
+        stack[-1][1].append(GitTreeLeaf(mode=b"040000", path=path[path.rfind("/")+1:], sha=sha))
+        stack[-1][2] += count
 
     return sha
 
@@ -1054,6 +3479,328 @@ def commit_create(repo, tree, parent, author, timestamp, message):
 
     return object_write(commit, repo)
 
+""" FSMONITOR
+ The daemon watches the worktree (inotify through ctypes, polling where inotify is not
+ available) and numbers the batches of changes it sees. A client sends "query <token>"
+ on .git/fsmonitor.sock and gets back a new token followed by the paths changed since
+ the token, or "*" when it can not tell (unknown token: daemon restarted, events lost).
+ reply: [new token] 0x00 then the paths, each followed by 0x00
+ """
+
+FSMONITOR_SOCKET = "fsmonitor.sock"
+FSMONITOR_POLL_INTERVAL = 1.0
+FSMONITOR_TIMEOUT = 5.0
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+FSMONITOR_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO |
+                  IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF)
+INOTIFY_EVENT = struct.Struct("iIII")
+
+class GitFsMonitor(object):
+    '''state of the fsmonitor daemon'''
+    #changes are numbered from 0 for every start id, tokens are "<start id>:<number>"
+    start_id = None
+    seq = 0
+    #path => number of the last batch it changed in
+    changes = None
+    #inotify: (libc, file descriptor) and watch descriptor => directory path
+    inotify = None
+    watches = None
+    #polling: path => stat data at the last poll
+    snapshot = None
+
+    def __init__(self, repo):
+        self.repo = repo
+        self.changes = dict()
+        self.watches = dict()
+        fsmonitor_reset(self)
+
+#Forgets every change: clients holding an older token get a full rescan
+def fsmonitor_reset(monitor):
+    monitor.start_id = os.urandom(8).hex()
+    monitor.seq = 0
+    monitor.changes.clear()
+
+def fsmonitor_changed(monitor, paths):
+    monitor.seq += 1
+    for path in paths:
+        monitor.changes[path] = monitor.seq
+
+def fsmonitor_inotify_init():
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+    except (OSError, AttributeError):
+        return None
+
+    if fd < 0:
+        return None
+    return libc, fd
+
+#Watches dir_path and every directory below it, returns the paths found
+def fsmonitor_watch(monitor, dir_path):
+    libc, fd = monitor.inotify
+    found = list()
+    stack = [dir_path]
+
+    while stack:
+        path = stack.pop()
+        wd = libc.inotify_add_watch(fd, os.fsencode(os.path.join(monitor.repo.worktree, path)), FSMONITOR_MASK)
+        if wd < 0:
+            if ctypes.get_errno() == errno.ENOENT:
+                continue #removed in the meantime
+            raise Exception("inotify_add_watch failed: {}".format(os.strerror(ctypes.get_errno())))
+        monitor.watches[wd] = path
+
+        try:
+            with os.scandir(os.path.join(monitor.repo.worktree, path)) as entries:
+                for entry in entries:
+                    if entry.name == ".git":
+                        continue
+                    found.append(os.path.join(path, entry.name))
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(os.path.join(path, entry.name))
+        except FileNotFoundError:
+            pass
+
+    return found
+
+def fsmonitor_read_events(monitor):
+    libc, fd = monitor.inotify
+    changed = list()
+
+    while True:
+        try:
+            data = os.read(fd, 65536)
+        except BlockingIOError:
+            break
+
+        pos = 0
+        while pos < len(data):
+            wd, mask, _, length = INOTIFY_EVENT.unpack_from(data, pos)
+            name = os.fsdecode(data[pos+16:pos+16+length].rstrip(b'\x00'))
+            pos += 16 + length
+
+            if mask & IN_Q_OVERFLOW:
+                #events were lost, nothing can be trusted anymore
+                fsmonitor_reset(monitor)
+                changed = list()
+                continue
+
+            dir_path = monitor.watches.get(wd)
+            if dir_path is None:
+                continue
+
+            if mask & IN_IGNORED:
+                del monitor.watches[wd]
+                continue
+
+            if mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+                changed.append(dir_path)
+                continue
+
+            if name == ".git" and dir_path == "":
+                continue
+
+            path = os.path.join(dir_path, name)
+            changed.append(path)
+
+            #files may be created in a new directory before it is watched
+            if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                changed.extend(fsmonitor_watch(monitor, path))
+
+    if changed:
+        fsmonitor_changed(monitor, changed)
+
+def fsmonitor_snapshot(repo):
+    result = dict()
+    stack = [""]
+
+    while stack:
+        dir_path = stack.pop()
+        try:
+            with os.scandir(os.path.join(repo.worktree, dir_path)) as entries:
+                for entry in entries:
+                    if entry.name == ".git":
+                        continue
+                    path = os.path.join(dir_path, entry.name)
+                    try:
+                        entry_stat = entry.stat(follow_symlinks=False)
+                    except FileNotFoundError:
+                        continue
+                    result[path] = (entry_stat.st_mtime_ns, entry_stat.st_ctime_ns, entry_stat.st_size, entry_stat.st_ino, entry_stat.st_mode)
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(path)
+        except (FileNotFoundError, NotADirectoryError):
+            pass
+
+    return result
+
+#Polling fallback: the worktree is compared with the previous snapshot
+def fsmonitor_poll(monitor):
+    snapshot = fsmonitor_snapshot(monitor.repo)
+
+    if monitor.snapshot is not None:
+        changed = [path for (path, data) in snapshot.items() if monitor.snapshot.get(path) != data]
+        changed.extend(path for path in monitor.snapshot if path not in snapshot)
+        if changed:
+            fsmonitor_changed(monitor, changed)
+
+    monitor.snapshot = snapshot
+
+def fsmonitor_reply(monitor, token):
+    #events already queued are taken into account before answering
+    if monitor.inotify:
+        fsmonitor_read_events(monitor)
+    else:
+        fsmonitor_poll(monitor)
+
+    new_token = "{}:{}".format(monitor.start_id, monitor.seq)
+
+    start_id, _, seq = (token or "").partition(":")
+    if start_id != monitor.start_id or not seq.isdigit():
+        paths = ["*"]
+    else:
+        seq = int(seq)
+        paths = [path for (path, changed) in monitor.changes.items() if changed > seq]
+
+    return b''.join([new_token.encode("ascii") + b'\x00'] + [os.fsencode(path) + b'\x00' for path in paths])
+
+def fsmonitor_run(repo):
+    monitor = GitFsMonitor(repo)
+
+    monitor.inotify = fsmonitor_inotify_init()
+    if monitor.inotify:
+        try:
+            fsmonitor_watch(monitor, "")
+        except Exception:
+            #watch limit reached, for example
+            os.close(monitor.inotify[1])
+            monitor.inotify = None
+    if not monitor.inotify:
+        fsmonitor_poll(monitor)
+
+    path = repo_file(repo, FSMONITOR_SOCKET)
+    if os.path.exists(path):
+        os.unlink(path)
+
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(path)
+    server.listen()
+
+    try:
+        while True:
+            readable = [server] + ([monitor.inotify[1]] if monitor.inotify else [])
+            ready, _, _ = select.select(readable, [], [], FSMONITOR_POLL_INTERVAL)
+
+            if monitor.inotify and monitor.inotify[1] in ready:
+                fsmonitor_read_events(monitor)
+            elif not monitor.inotify and not ready:
+                fsmonitor_poll(monitor)
+
+            if server in ready:
+                conn, _ = server.accept()
+                with conn:
+                    request = fsmonitor_recv(conn).decode("utf8").strip()
+                    command, _, token = request.partition(" ")
+
+                    if command == "quit":
+                        conn.sendall(b"ok")
+                        break
+                    elif command == "query":
+                        conn.sendall(fsmonitor_reply(monitor, token))
+    finally:
+        server.close()
+        if os.path.exists(path):
+            os.unlink(path)
+
+def fsmonitor_recv(conn):
+    result = list()
+    while True:
+        data = conn.recv(65536)
+        if not data:
+            break
+        result.append(data)
+        if data.endswith(b"\n"):
+            break
+    return b''.join(result)
+
+#Sends a request to the daemon, returns the reply or None if it is not running
+def fsmonitor_request(repo, request):
+    path = repo_file(repo, FSMONITOR_SOCKET)
+    if not os.path.exists(path):
+        return None
+
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as conn:
+            conn.settimeout(FSMONITOR_TIMEOUT)
+            conn.connect(path)
+            conn.sendall(request.encode("utf8") + b"\n")
+            conn.shutdown(socket.SHUT_WR)
+            return fsmonitor_recv(conn)
+    except OSError:
+        return None
+
+#Returns (new token, paths changed since token or None for everything), None if the daemon is not running
+def fsmonitor_query(repo, token):
+    reply = fsmonitor_request(repo, "query {}".format(token or ""))
+    if reply is None:
+        return None
+
+    parts = [os.fsdecode(part) for part in reply.split(b'\x00')[:-1]]
+    if not parts:
+        return None
+
+    paths = parts[1:]
+    if paths == ["*"]:
+        return parts[0], None
+    return parts[0], paths
+
+def fsmonitor_start(repo):
+    if fsmonitor_request(repo, "query") is not None:
+        raise Exception("The fsmonitor daemon is already running")
+
+    pid = os.fork()
+    if pid == 0:
+        #daemon: detached from the terminal and the parent's session
+        os.setsid()
+        if os.fork():
+            os._exit(0)
+        null = os.open(os.devnull, os.O_RDWR)
+        for fd in (0, 1, 2):
+            os.dup2(null, fd)
+        try:
+            fsmonitor_run(repo)
+        finally:
+            os._exit(0)
+
+    os.waitpid(pid, 0)
+
+    #waiting for the daemon to accept queries
+    deadline = time.monotonic() + FSMONITOR_TIMEOUT
+    while time.monotonic() < deadline:
+        if fsmonitor_request(repo, "query") is not None:
+            return
+        time.sleep(0.05)
+    raise Exception("The fsmonitor daemon did not start")
+
+def fsmonitor_stop(repo):
+    if fsmonitor_request(repo, "quit") is None:
+        raise Exception("The fsmonitor daemon is not running")
+
 """RGIT COMMANDS"""
 
 def rgit_init(args):
@@ -1069,6 +3816,10 @@ def rgit_hash_object(args):
     else:
         repo = None
     
+    if args.type == "blob":
+        print(object_hash_file(args.path, repo))
+        return
+
     with open(args.path, "rb") as file:
         sha = object_hash(file, args.type.encode(), repo)
         print(sha)
@@ -1076,14 +3827,38 @@ def rgit_hash_object(args):
 def rgit_log(args):
     repo = repo_find_root()
 
-    print("digraph rgitlog{")
-    print("  node[shape=rect]")
-    log_graphviz(repo, object_find(repo, args.commit), set())
-    print("}")
+    walk = GitRevWalk(repo, first_parent=args.first_parent)
+    for name in args.commit:
+        revwalk_push_revision(walk, name)
+
+    match args.format:
+        case "graphviz": log_graphviz(repo, walk, args.max_count)
+        case "text": log_text(repo, walk, args.max_count)
+
+def rgit_merge_base(args):
+    repo = repo_find_root()
+    one, two = (object_find(repo, name, b'commit') for name in args.commit)
+
+    #like git, the answer is the exit status
+    if args.is_ancestor:
+        sys.exit(0 if commit_is_ancestor(repo, one, two) else 1)
+
+    bases = merge_bases(repo, one, two)
+    if not bases:
+        sys.exit(1)
+
+    for sha in bases if args.all else bases[:1]:
+        print(sha)
+
+def rgit_commit_graph(args):
+    repo = repo_find_root()
+
+    match args.action:
+        case "write": commit_graph_write(repo)
 
 def rgit_ls_tree(args):
     repo = repo_find_root()
-    ls_tree(repo, args.tree, args.recursive)
+    ls_tree(repo, args.tree, args.recursive, paths=args.path)
 
 def rgit_checkout(args):
     repo = repo_find_root()
@@ -1136,7 +3911,7 @@ def rgit_ls_files(args):
     repo = repo_find_root()
     index = index_read(repo)
     if args.verbose:
-        print("Index file format v{}, containing {} entries.".format(index.version, len(intex.entries)))
+        print("Index file format v{}, containing {} entries.".format(index.version, len(index.entries)))
 
     for entry in index.entries:
         print(entry.name)
@@ -1164,21 +3939,72 @@ def rgit_ls_files(args):
                 entry.flag_stage,
                 entry.flag_assume_valid))
 
+#Paths read from stdin, one per line or NUL-terminated
+def check_ignore_read_paths(stream, zero):
+    if not zero:
+        for line in stream:
+            yield os.fsdecode(line.rstrip(b"\n"))
+        return
+    pending = b""
+    for chunk in iter(lambda: stream.read(OBJECT_STREAM_CHUNK), b""):
+        paths = (pending + chunk).split(b"\0")
+        pending = paths.pop()
+        for path in paths:
+            yield os.fsdecode(path)
+    if pending:
+        yield os.fsdecode(pending)
+
 def rgit_check_ignore(args):
+    if args.stdin == bool(args.path):
+        raise Exception("check-ignore takes either paths or --stdin")
+    if args.z and not args.stdin:
+        raise Exception("-z only makes sense with --stdin")
+
     repo = repo_find_root()
+    #the rules are loaded once for all the paths
     rules = gitignore_read(repo)
-    for path in args.path:
-        if check_ignore(rules, path):
-            print(path)
+    paths = check_ignore_read_paths(sys.stdin.buffer, args.z) if args.stdin else args.path
+    end = b"\0" if args.z else b"\n"
+    #results go through the buffered binary stdout, flushed at the end
+    out = sys.stdout.buffer
 
-def rgit_status(_):
+    for path in paths:
+        if not path:
+            continue
+        #a trailing / names a directory, as in the ignore files
+        is_dir = path.endswith("/") or os.path.isdir(os.path.join(repo.worktree, path))
+        result = check_ignore_match(rules, path.rstrip("/"), is_dir)
+        if result == None:
+            continue
+        (ruleset, index) = result
+        (pattern, value, number, line) = ruleset.rules[index]
+        #--verbose also reports the negated patterns, which decide a path is not ignored
+        if args.verbose:
+            fields = (ruleset.source, str(number), line, path)
+            if args.z:
+                out.write(b"".join(os.fsencode(field) + end for field in fields))
+            else:
+                out.write(os.fsencode("{}:{}:{}\t{}\n".format(*fields)))
+        elif value:
+            out.write(os.fsencode(path) + end)
+    out.flush()
+
+def rgit_status(args):
     repo = repo_find_root()
     index = index_read(repo)
 
     rgit_status_branch(repo)
     rgit_status_head_index(repo, index)
     print()
-    rgit_status_index_worktree(repo, index)
+    refreshed = rgit_status_index_worktree(repo, index, status_jobs(repo, args.jobs))
+
+    #Opportunistic refresh: stat data of unchanged files is written back, unless
+    #another process changed the index meanwhile or holds its lock
+    if refreshed:
+        try:
+            index_write(repo, index, verify=True)
+        except GitIndexLockedError:
+            pass
 
 def rgit_status_branch(repo):
     branch = branch_get_active(repo)
@@ -1203,64 +4029,125 @@ def rgit_status_head_index(repo, index):
     for entry in head.keys():
         print("  deleted: ", entry)
 
-def rgit_status_index_worktree(repo, index):
+def rgit_status_index_worktree(repo, index, jobs=1):
     print("Changes not staged for commit:")
 
-    ignore = gitignore_read(repo)
-
-    gitdir_prefix = repo.gitdir + os.path.sep
+    #With the fsmonitor, only the entries changed since the last status are checked
+    old_token = index.fsmonitor_token
+    dirty = status_fsmonitor(repo, index)
+    if dirty is None:
+        entries = index.entries
+    else:
+        entries = fsmonitor_dirty_entries(index, dirty)
 
-    all_files = list()
+    #Traversing the index + compare files with cached version
+    refreshed = False
+    invalid = set()
+    for (entry, (state, entry_refreshed)) in zip(entries, index_check_worktree(repo, index, jobs, entries)):
+        refreshed = refreshed or entry_refreshed
 
-    #Walking the filesystem
-    for (root, _, files) in os.walk(repo.worktree, True):
-        if root == repo.gitdir or root.startswith(gitdir_prefix):
-            continue
-        for file in files:
-            full_path = os.path.join(root, file)
-            rel_path = os.path.relpath(full_path, repo.worktree)
-            all_files.append(rel_path)
+        match state:
+            case "deleted": print("  deleted: ",entry.name)
+            case "modified": print("  modified:", entry.name)
 
-    #Traversing the index + compare files with cached version\
-    for entry in index.entries:
-        full_path = os.path.join(repo.worktree, entry.name)
-
-        # file name is in index
-        if not os.path.exists(full_path):
-            print("  deleted: ",entry.name)
-        else:
-            stat = os.stat(full_path)
-
-            #compare metadata
-            ctime_ns = entry.ctime[0] * 10**9 + entry.ctime[1]
-            mtime_ns = entry.mtime[0] * 10**9 +entry.mtime[1]
-            if (stat.st_ctime_ns != ctime_ns) or (stat.st_mtime_ns != mtime_ns):
-                #if different, in-depth comparison
-                # this will crash on symlinks to dir.
-                with open(full_path, "rb") as fd:
-                    new_sha = object_hash(fd, b"blob", None)
-                    #if hashes are the same => files are the same
-                    same = entry.sha == new_sha
-
-                    if not same:
-                        print("  modified:", entry.name)
-        if entry.name in all_files:
-            all_files.remove(entry.name)
+        if state:
+            invalid.add(entry.name)
+    index.fsmonitor_invalid = invalid
 
     print()
     print("Untracked files:")
 
-    for file in all_files:
-        if not check_ignore(ignore, file):
-            print(" ", file)
+    dirty_dirs = None
+    if dirty is not None:
+        dirty_dirs = set(dirty) | set(os.path.dirname(path) for path in dirty)
+
+    untracked, cache_changed = status_untracked(repo, index, dirty_dirs)
+    for file in untracked:
+        print(" ", file)
+
+    return refreshed or cache_changed or index.fsmonitor_token != old_token
+
+#Returns (sorted untracked files, True if the untracked cache was updated).
+#Ignored directories are pruned during the walk and tracked files are found
+#with a set lookup. The untracked cache is dropped when the ignore rules change.
+#It is off by default (core.untrackedCache): git warns about the RGUC extension
+#it does not know every time it reads the index.
+def status_untracked(repo, index, dirty_dirs=None):
+    ignore = gitignore_read(repo, index)
+    tracked = set(entry.name for entry in index.entries)
+
+    cache = None
+    dropped = False
+    if repo.conf.getboolean("core", "untrackedCache", fallback=False):
+        cache = index.untracked_cache
+        if cache is None or cache.key != ignore.key:
+            cache = GitUntrackedCache(ignore.key)
+            cache.changed = True
+        index.untracked_cache = cache
+    elif index.untracked_cache is not None:
+        #turned off: the extension goes away with the next index write
+        index.untracked_cache = None
+        dropped = True
+
+    #the fsmonitor only helps when the listings of the other directories are cached
+    if cache is None or not cache.dirs:
+        dirty_dirs = None
+
+    untracked = [f for f in worktree_walk(repo, ignore, cache=cache, index=index, dirty_dirs=dirty_dirs) if f not in tracked]
+    untracked.sort()
+
+    #directories removed since the last walk are dropped from the cache
+    if cache is not None:
+        if len(cache.visited) != len(cache.dirs):
+            cache.changed = True
+        cache.dirs = cache.visited
+
+    return untracked, dropped or (cache is not None and cache.changed)
+
+#Paths changed since the token of the index, or None when everything has to be
+#checked (core.fsmonitor off, daemon not running, unknown token). The index gets
+#the new token, it is saved with the index at the end of status.
+def status_fsmonitor(repo, index):
+    if not repo.conf.getboolean("core", "fsmonitor", fallback=False):
+        index.fsmonitor_token = None
+        return None
+
+    reply = fsmonitor_query(repo, index.fsmonitor_token)
+    if reply is None:
+        index.fsmonitor_token = None
+        return None
+
+    token, paths = reply
+    index.fsmonitor_token = token
+    return paths
+
+#Entries to check: changed paths, entries below changed directories (a directory
+#may be moved as a whole) and entries the last status did not find clean
+def fsmonitor_dirty_entries(index, dirty):
+    names = [entry.name for entry in index.entries]
+    selected = set()
+
+    for path in dirty:
+        start = bisect.bisect_left(names, path)
+        end = bisect.bisect_left(names, path + "0") #'0' follows '/'
+        for i in range(start, end):
+            if names[i] == path or names[i].startswith(path + "/"):
+                selected.add(i)
+
+    invalid = index.fsmonitor_invalid or set()
+    for (i, name) in enumerate(names) if invalid else ():
+        if name in invalid:
+            selected.add(i)
+
+    return [index.entries[i] for i in sorted(selected)]
 
 def rgit_rm(args):
     repo = repo_find_root()
-    rm(repo, args.path)
+    rm(repo, args.path, recursive=args.recursive)
 
 def rgit_add(args):
     repo = repo_find_root()
-    add(repo, args.path)
+    add(repo, args.path, force=args.force)
 
 def rgit_commit(args):
     repo = repo_find_root()
@@ -1285,6 +4172,35 @@ def rgit_commit(args):
         with open(repo_file(repo, "HEAD"), "w") as fd:
             fd.write("\n")
 
+    #the index keeps the SHAs of the trees for the next commit, as with the
+    #refresh in status it is not written over an index changed since it was read,
+    #and an index locked by another process is not an error
+    try:
+        index_write(repo, index, verify=True)
+    except GitIndexLockedError:
+        pass
+
+def rgit_fsmonitor(args):
+    repo = repo_find_root()
+
+    match args.action:
+        case "start": fsmonitor_start(repo)
+        case "stop": fsmonitor_stop(repo)
+        case "run": fsmonitor_run(repo)
+        case "status":
+            if fsmonitor_request(repo, "query") is None:
+                print("fsmonitor daemon is not running.")
+            else:
+                print("fsmonitor daemon is watching {}.".format(repo.worktree))
+
+def rgit_repack(args):
+    repo = repo_find_root()
+    name = repack(repo)
+    if name:
+        print("Packed {} objects into {}.".format(repo_packs(repo)[0].count, name))
+    else:
+        print("Nothing to pack.")
+
 """Parser and subparser for arguments"""
 
 argparser = argparse.ArgumentParser(
@@ -1328,9 +4244,36 @@ argsp.add_argument("path",
 
 argsp = argsubparsers.add_parser("log", help="Display history of a given commit.")
 argsp.add_argument("commit",
-                    default="HEAD",
-                    nargs="?",
-                    help="Commit to start at.")
+                    default=["HEAD"],
+                    nargs="*",
+                    help="Commits to start at, ^A or A..B to leave out the history of A.")
+argsp.add_argument("-n", "--max-count",
+                    type=int,
+                    default=None,
+                    help="Show at most this many commits.")
+argsp.add_argument("--first-parent",
+                    action="store_true",
+                    help="Follow only the first parent of merge commits.")
+argsp.add_argument("--format",
+                    choices=["graphviz", "text"],
+                    default="graphviz",
+                    help="Graphviz graph (default) or text, as git log.")
+
+argsp = argsubparsers.add_parser("merge-base", help="Find the best common ancestor of two commits.")
+argsp.add_argument("commit",
+                    nargs=2,
+                    help="The two commits.")
+argsp.add_argument("--all",
+                    action="store_true",
+                    help="Print all the best common ancestors instead of one.")
+argsp.add_argument("--is-ancestor",
+                    action="store_true",
+                    help="Exit with status 0 if the first commit is an ancestor of the second, 1 otherwise.")
+
+argsp = argsubparsers.add_parser("commit-graph", help="Write the commit-graph used to walk the history.")
+argsp.add_argument("action",
+                    choices=["write"],
+                    help="write objects/info/commit-graph for the commits reachable from the refs")
 
 argsp = argsubparsers.add_parser("ls-tree", help="Print a tree object.")
 argsp.add_argument("-r",
@@ -1339,6 +4282,9 @@ argsp.add_argument("-r",
                     help="Recurse into sub-trees")
 argsp.add_argument("tree",
                     help=" A tree object")
+argsp.add_argument("path",
+                    nargs="*",
+                    help="Only show these paths")
 
 argsp = argsubparsers.add_parser("checkout", help="Checkout a commit (inside of a directory)")
 argsp.add_argument("commit",
@@ -1375,15 +4321,36 @@ argsp = argsubparsers.add_parser("ls-files", help="List all the staged files")
 argsp.add_argument("--verbose", action="store_true", help="Show everything.")
 
 argsp = argsubparsers.add_parser("check-ignore", help = "Check path(s) against ignore rules.")
-argsp.add_argument("path", nargs="+", help="Paths to check")
+argsp.add_argument("--stdin", action="store_true", help="Read the paths from standard input, one per line.")
+argsp.add_argument("-z", action="store_true", help="Paths are read and written NUL-terminated (with --stdin).")
+argsp.add_argument("-v", "--verbose", action="store_true", help="Show the source, line number and pattern that decided each path.")
+argsp.add_argument("path", nargs="*", help="Paths to check")
 
 argsp = argsubparsers.add_parser("status", help = "Show the working tree status.")
+argsp.add_argument("-j", "--jobs",
+                    type=int,
+                    default=None,
+                    help="Number of threads checking the worktree (default: one per core, see core.preloadIndex)")
 
 argsp = argsubparsers.add_parser("rm", help = "Remove files from the working tree and the index.")
-argsp.add_argument("path", nargs="+", help = "Files to remove")
+argsp.add_argument("-r",
+                    dest="recursive",
+                    action="store_true",
+                    help="Allow recursive removal when a directory is given")
+argsp.add_argument("path", nargs="+", help = "Files, directories or glob pathspecs to remove")
 
 argsp = argsubparsers.add_parser("add", help = "Add files contents to the index.")
-argsp.add_argument("path", nargs="+", help = "Files to add")
+argsp.add_argument("-f", "--force",
+                    action="store_true",
+                    help="Allow adding otherwise ignored files.")
+argsp.add_argument("path", nargs="+", help = "Files, directories or glob pathspecs to add")
+
+argsp = argsubparsers.add_parser("fsmonitor", help="Run the filesystem monitor used by status (with core.fsmonitor = true).")
+argsp.add_argument("action",
+                    choices=["start", "stop", "run", "status"],
+                    help="start/stop the daemon, run it in the foreground or check if it is running")
+
+argsp = argsubparsers.add_parser("repack", help="Pack all objects of the repository into a single packfile.")
 
 argsp =argsubparsers.add_parser("commit", help="Record changes to the repository.")
 
@@ -1402,11 +4369,15 @@ def main(argv = sys.argv[1:]):
         case "check-ignore": rgit_check_ignore(args)
         case "checkout": rgit_checkout(args)
         case "commit": rgit_commit(args)
+        case "commit-graph": rgit_commit_graph(args)
+        case "fsmonitor": rgit_fsmonitor(args)
         case "hash-object": rgit_hash_object(args)
         case "init": rgit_init(args)
         case "log": rgit_log(args)
         case "ls-files": rgit_ls_files(args)
         case "ls-tree": rgit_ls_tree(args)
+        case "merge-base": rgit_merge_base(args)
+        case "repack": rgit_repack(args)
         case "rev-parse": rgit_rev_parse(args)
         case "rm": rgit_rm(args)
         case "show-ref": rgit_show_ref(args)